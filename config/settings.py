@@ -1,5 +1,8 @@
 from pathlib import Path
 import os
+
+from django.core.exceptions import ImproperlyConfigured
+
 BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = 'replace-me-with-a-secure-key'
 DEBUG = True
@@ -31,6 +34,7 @@ CHANNEL_LAYERS = {
 }
 
 MIDDLEWARE = [
+    'patients.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -52,7 +56,53 @@ TEMPLATES = [{
 }]
 
 WSGI_APPLICATION = 'config.wsgi.application'
-DATABASES = {'default': {'ENGINE':'django.db.backends.sqlite3','NAME': BASE_DIR / 'db.sqlite3'}}
+# Database profile, chosen with DATABASE_PROFILE:
+#   development  SQLite with its stock settings (default)
+#   production   SQLite in WAL mode with SQLITE_PRAGMAS and persistent connections, so
+#                run_mqtt can keep writing while the web process reads
+#   postgresql   PostgreSQL from the POSTGRES_* variables with persistent connections
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'development')
+# Seconds a connection is kept for reuse by later requests (0 closes it after each request)
+DATABASE_CONN_MAX_AGE = int(os.environ.get(
+    'DATABASE_CONN_MAX_AGE', '0' if DATABASE_PROFILE == 'development' else '600'
+))
+if DATABASE_PROFILE == 'postgresql':
+    DATABASES = {'default': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('POSTGRES_DB', 'patients'),
+        'USER': os.environ.get('POSTGRES_USER', 'patients'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        # Transaction-mode poolers (PgBouncer) cannot keep server-side cursors between transactions
+        'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('POSTGRES_POOL_MODE') == 'transaction',
+        'OPTIONS': {'connect_timeout': int(os.environ.get('POSTGRES_CONNECT_TIMEOUT', '5'))},
+    }}
+elif DATABASE_PROFILE in ('development', 'production'):
+    DATABASES = {'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': DATABASE_CONN_MAX_AGE > 0,
+    }}
+else:
+    raise ImproperlyConfigured(f'Unknown DATABASE_PROFILE {DATABASE_PROFILE!r}')
+
+# Applied to every new SQLite connection by patients.signals. WAL lets readers and the
+# single writer proceed together; NORMAL sync is durable across crashes in WAL mode,
+# and only a power loss can drop the last commits.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    # Milliseconds a connection waits for a competing writer before "database is locked"
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', '10000')),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    # Negative sizes are in KiB: 64 MiB of page cache per connection
+    'cache_size': int(os.environ.get('SQLITE_CACHE_SIZE', '-65536')),
+    'temp_store': 'memory',
+} if DATABASE_PROFILE == 'production' else {}
 AUTH_PASSWORD_VALIDATORS = []
 LANGUAGE_CODE='en-us'
 TIME_ZONE='UTC'
@@ -76,6 +126,27 @@ EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'True') == 'True'
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
 
+# Request metrics served at /metrics (admins, or a scraper sending `Authorization: Bearer <TOKEN>`)
+METRICS = {
+    'TOKEN': os.environ.get('METRICS_TOKEN', ''),
+    # Requests slower than this are counted; SLOW_SAMPLE_RATE of them are logged with their queries
+    'SLOW_REQUEST_SECONDS': float(os.environ.get('METRICS_SLOW_REQUEST_SECONDS', '0.5')),
+    'SLOW_SAMPLE_RATE': float(os.environ.get('METRICS_SLOW_SAMPLE_RATE', '1.0')),
+}
+
+# Outbox drained by `manage.py send_queued_mail`
+MAIL_QUEUE = {
+    # Messages sent per SMTP connection
+    'BATCH_SIZE': int(os.environ.get('MAIL_QUEUE_BATCH_SIZE', '50')),
+    # Seconds between polls when the outbox is empty
+    'POLL_INTERVAL': float(os.environ.get('MAIL_QUEUE_POLL_INTERVAL', '5')),
+    # Failed sends are retried after RETRY_BACKOFF, 2x, 4x... seconds, up to MAX_ATTEMPTS tries
+    'MAX_ATTEMPTS': int(os.environ.get('MAIL_QUEUE_MAX_ATTEMPTS', '5')),
+    'RETRY_BACKOFF': float(os.environ.get('MAIL_QUEUE_RETRY_BACKOFF', '60')),
+    # Seconds a claimed batch stays hidden from other workers
+    'LEASE': float(os.environ.get('MAIL_QUEUE_LEASE', '300')),
+}
+
 # MQTT Configuration
 MQTT = {
     'BROKER': os.environ.get('MQTT_BROKER', 'localhost'),
@@ -84,4 +155,27 @@ MQTT = {
     'DATA_TOPIC': '+/+/measurements',  # Format: {device_id}/{session_id}/measurements
     # Control topic for sending commands to devices
     'CONTROL_TOPIC_PREFIX': 'device/',  # Format: device/{device_id}/control
+    # Control messages held by the web process's publisher while the broker is unreachable
+    'PUBLISH_QUEUE_SIZE': int(os.environ.get('MQTT_PUBLISH_QUEUE_SIZE', '1000')),
+    # Ingestion buffering: flush when either limit is reached
+    'BATCH_SIZE': int(os.environ.get('MQTT_BATCH_SIZE', '500')),
+    'FLUSH_INTERVAL': float(os.environ.get('MQTT_FLUSH_INTERVAL', '1.0')),
+    # Sessions are completed by a {"complete": true} message or after this many idle seconds
+    'SESSION_IDLE_TIMEOUT': float(os.environ.get('MQTT_SESSION_IDLE_TIMEOUT', '30')),
+    # Device/session lookup cache: changes made elsewhere are seen within CACHE_TTL seconds
+    'CACHE_SIZE': int(os.environ.get('MQTT_CACHE_SIZE', '1024')),
+    'CACHE_TTL': float(os.environ.get('MQTT_CACHE_TTL', '30')),
+    # WebSocket frames of new points: at most one per session every FRAME_INTERVAL seconds
+    'FRAME_INTERVAL': float(os.environ.get('MQTT_FRAME_INTERVAL', '0.25')),
+    'FRAME_MAX_POINTS': int(os.environ.get('MQTT_FRAME_MAX_POINTS', '5000')),
+    # run_mqtt --asyncio: database threads and the messages each may have waiting
+    'DB_THREADS': int(os.environ.get('MQTT_DB_THREADS', '2')),
+    'QUEUE_SIZE': int(os.environ.get('MQTT_QUEUE_SIZE', '10000')),
+    # run_mqtt --workers: shared-subscription group the workers join
+    'SHARE_GROUP': os.environ.get('MQTT_SHARE_GROUP', 'ingest'),
+    # run_mqtt observability: Prometheus port (0 = off), summary line period, share of messages traced at -v 2
+    'METRICS_HOST': os.environ.get('MQTT_METRICS_HOST', '127.0.0.1'),
+    'METRICS_PORT': int(os.environ.get('MQTT_METRICS_PORT', '0')),
+    'STATS_INTERVAL': float(os.environ.get('MQTT_STATS_INTERVAL', '60')),
+    'LOG_SAMPLE_RATE': float(os.environ.get('MQTT_LOG_SAMPLE_RATE', '1.0')),
 }
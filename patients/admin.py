@@ -1,20 +1,107 @@
-from django.contrib import admin
-from .models import Patient, MeasurementSession, SpectralPoint
+import os
+from django import forms
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.db.models import F
+from django.shortcuts import render
+from django.urls import path
+from django.utils import timezone
+from .importing import IMPORT_FIELDS, READERS, PatientImporter
+from .models import Patient, MeasurementSession, Spectrum, SpectralPoint, OutboundEmail
+
+class PatientImportForm(forms.Form):
+    file = forms.FileField(help_text='CSV or XLSX with a header row')
+    batch_size = forms.IntegerField(min_value=1, initial=1000, help_text='Rows written per transaction')
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if os.path.splitext(file.name)[1].lstrip('.').lower() not in READERS:
+            raise forms.ValidationError('Upload a .csv or .xlsx file')
+        return file
 
 @admin.register(Patient)
 class PatientAdmin(admin.ModelAdmin):
     list_display = ('patient_id','name','age','gender')
     search_fields = ('patient_id','name')
 
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='patients_patient_import'),
+        ] + super().get_urls()
+
+    def import_view(self, request):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        errors = []
+        if request.method == 'POST':
+            form = PatientImportForm(request.POST, request.FILES)
+            if form.is_valid():
+                upload = form.cleaned_data['file']
+                reader = READERS[os.path.splitext(upload.name)[1].lstrip('.').lower()]
+                importer = PatientImporter(batch_size=form.cleaned_data['batch_size'])
+                importer.run(reader(upload.file))
+                errors = importer.errors
+                messages.success(request, f'Imported {importer.imported} patient(s); {len(errors)} row(s) rejected.')
+        else:
+            form = PatientImportForm()
+        return render(request, 'admin/patients/patient/import.html', {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import patients',
+            'form': form,
+            'fields': IMPORT_FIELDS,
+            'errors': errors,
+        })
+
 @admin.register(MeasurementSession)
 class SessionAdmin(admin.ModelAdmin):
-    list_display = ('session_id', 'patient', 'initiated_by', 'created_at', 'status', 'device')
+    list_display = ('session_id', 'patient', 'initiated_by', 'created_at', 'status', 'device', 'points', 'peak_wavelength')
     list_filter = ('status', 'created_at', 'device')
     readonly_fields = ('created_at', 'updated_at')
     search_fields = ('session_id', 'patient__name', 'device__name', 'device__device_id')
     list_select_related = ('patient', 'initiated_by', 'device')
 
+    def get_queryset(self, request):
+        # Summary columns come from the spectrum row without loading its arrays
+        return super().get_queryset(request).annotate(
+            spectrum_points=F('spectrum__point_count'),
+            spectrum_peak=F('spectrum__peak_wavelength'),
+        )
+
+    @admin.display(description='Points', ordering='spectrum_points')
+    def points(self, obj):
+        return obj.spectrum_points or 0
+
+    @admin.display(description='Peak (nm)', ordering='spectrum_peak')
+    def peak_wavelength(self, obj):
+        return round(obj.spectrum_peak, 1) if obj.spectrum_peak is not None else None
+
+@admin.register(Spectrum)
+class SpectrumAdmin(admin.ModelAdmin):
+    list_display = ('session', 'point_count', 'wavelength_min', 'wavelength_max', 'intensity_mean',
+                    'peak_wavelength', 'area', 'dtype', 'updated_at')
+    readonly_fields = ('point_count', *Spectrum.SUMMARY_FIELDS, 'created_at', 'updated_at')
+    search_fields = ('session__session_id',)
+    list_select_related = ('session',)
+
+    def get_queryset(self, request):
+        # The packed arrays are never shown here
+        return super().get_queryset(request).defer('wavelengths', 'intensities', 'revisions')
+
 @admin.register(SpectralPoint)
 class SpectralAdmin(admin.ModelAdmin):
     list_display = ('session','wavelength','intensity')
     ordering = ('session','wavelength')
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'status', 'attempts', 'created_at', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+    readonly_fields = ('attempts', 'last_error', 'created_at', 'sent_at')
+    search_fields = ('subject',)
+    actions = ['retry_now']
+
+    @admin.action(description='Retry selected emails now')
+    def retry_now(self, request, queryset):
+        updated = queryset.exclude(status='sent').update(status='pending', attempts=0, next_attempt_at=timezone.now())
+        self.message_user(request, f'{updated} email(s) queued for retry.')
@@ -0,0 +1,203 @@
+"""asyncio ingestion engine: MQTT I/O on the event loop, database writes on a thread pool."""
+import asyncio
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt
+
+from . import metrics
+from .ingestion import FrameCoalescer
+
+logger = logging.getLogger(__name__)
+
+
+def lane_for(device_id, lanes):
+    """Return the lane for ``device_id``, spread evenly however alike the IDs are.
+
+    CRC32 is linear, so IDs that differ in one character (DEV-001, DEV-002)
+    cluster on a few values modulo small lane counts.
+    """
+    digest = hashlib.blake2b(device_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % lanes
+
+
+class AsyncioSocketDriver:
+    """Drive a paho client's socket from an asyncio event loop instead of a thread.
+
+    Reads and writes happen when the loop reports the socket ready, and
+    ``loop_misc`` (keepalive pings, retries) runs once a second, so the
+    connection stays healthy however long database work takes elsewhere.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self._misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self._misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self._misc:
+            self._misc.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class AsyncIngestion:
+    """Receive measurements on the event loop and persist them on worker threads.
+
+    Messages are routed by a hash of their device ID into one of ``lanes``
+    bounded queues, so each session is processed in order while different
+    devices proceed in parallel on a pool of ``lanes`` threads. ``process``
+    (device_id, session_id, payload) does the decoding, lookups and
+    buffering there. When a lane is full the message is dropped rather than
+    blocking the network loop; ``dropped`` counts those and ``delayed``
+    counts messages that waited longer than ``max_wait`` seconds in a queue.
+    Frames of new points are sent with native ``await group_send``.
+    """
+
+    def __init__(self, client, process, buffer, channel_layer=None, lanes=2,
+                 queue_size=10000, chunk_size=100, max_wait=1.0,
+                 frame_interval=0.25, frame_max_points=5000, reconnect_delay=30, on_error=None):
+        self.client = client
+        self.process = process
+        self.buffer = buffer
+        self.channel_layer = channel_layer
+        self.lanes = lanes
+        self.queue_size = queue_size
+        self.chunk_size = chunk_size
+        self.max_wait = max_wait
+        self.reconnect_delay = reconnect_delay
+        self.on_error = on_error or (lambda message: logger.error(message))
+        self.frames = FrameCoalescer(self.queue_frame, interval=frame_interval, max_points=frame_max_points)
+        self.executor = ThreadPoolExecutor(max_workers=lanes, thread_name_prefix='ingest')
+        self.received = 0
+        self.dropped = 0
+        self.delayed = 0
+        self._queues = []
+        self._outgoing = []
+        client.on_message = self.on_message
+
+    def on_message(self, client, userdata, msg):
+        """Runs on the event loop: route the raw message without touching the database."""
+        topic_parts = msg.topic.split('/')
+        if len(topic_parts) < 3 or topic_parts[2] != 'measurements':
+            return
+        self.received += 1
+        lane = self._queues[lane_for(topic_parts[0], self.lanes)]
+        try:
+            lane.put_nowait((time.monotonic(), topic_parts[0], topic_parts[1], msg.payload))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            metrics.mqtt_rejected.inc(reason='queue_full')
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                self.on_error(f'Ingestion queue full; dropped {self.dropped} message(s) so far')
+
+    def queue_frame(self, session_id, text):
+        self._outgoing.append((session_id, text))
+
+    async def send_frames(self):
+        outgoing, self._outgoing = self._outgoing, []
+        if not self.channel_layer:
+            return
+        for session_id, text in outgoing:
+            started = time.perf_counter()
+            try:
+                await self.channel_layer.group_send(f'session_{session_id}', {
+                    'type': 'session_points',
+                    'text': text,
+                })
+                metrics.mqtt_channel_send.observe(time.perf_counter() - started)
+            except Exception as e:
+                self.on_error(f'WebSocket frame failed: {str(e)}')
+
+    def process_chunk(self, chunk):
+        for _, device_id, session_id, payload in chunk:
+            self.process(device_id, session_id, payload)
+
+    def flush(self):
+        try:
+            self.buffer.flush()
+        except Exception as e:
+            self.on_error(f'Error writing buffered points: {str(e)}')
+
+    async def consume(self, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = [await queue.get()]
+            while len(chunk) < self.chunk_size:
+                try:
+                    chunk.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            now = time.monotonic()
+            self.delayed += sum(1 for received, *_ in chunk if now - received > self.max_wait)
+            try:
+                await loop.run_in_executor(self.executor, self.process_chunk, chunk)
+            except Exception as e:
+                self.on_error(f'Error processing messages: {str(e)}')
+            finally:
+                for _ in chunk:
+                    queue.task_done()
+
+    async def reconnect(self, state):
+        """Reconnect after a dropped connection, doubling the wait after each failure."""
+        if self.client.is_connected() or time.monotonic() < state['next_attempt']:
+            return
+        try:
+            self.client.reconnect()
+            state['delay'] = 1
+        except OSError as e:
+            self.on_error(f'Reconnect failed: {str(e)}; retrying in {state["delay"]}s')
+            state['next_attempt'] = time.monotonic() + state['delay']
+            state['delay'] = min(state['delay'] * 2, self.reconnect_delay)
+
+    async def run(self, host, port, keepalive, stopping, tick=0.1, on_tick=None):
+        """Ingest until the ``stopping`` event (a ``threading.Event``) is set, then drain.
+
+        ``on_tick`` is called on the event loop every ``tick`` seconds.
+        """
+        loop = asyncio.get_running_loop()
+        AsyncioSocketDriver(loop, self.client)
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.lanes)]
+        metrics.mqtt_queue_depth.set_function(lambda: sum(queue.qsize() for queue in self._queues))
+        consumers = [loop.create_task(self.consume(queue)) for queue in self._queues]
+        self.client.connect(host, port, keepalive)
+        reconnect_state = {'delay': 1, 'next_attempt': time.monotonic() + 1}
+        try:
+            while not stopping.is_set():
+                await asyncio.sleep(tick)
+                await self.reconnect(reconnect_state)
+                if self.buffer.is_due():
+                    await loop.run_in_executor(self.executor, self.flush)
+                self.frames.release()
+                await self.send_frames()
+                if on_tick:
+                    on_tick()
+        finally:
+            # Stop taking messages, finish what is queued, then write and announce it
+            self.client.disconnect()
+            await asyncio.gather(*(queue.join() for queue in self._queues))
+            for consumer in consumers:
+                consumer.cancel()
+            await loop.run_in_executor(self.executor, self.flush)
+            self.frames.release(force=True)
+            await self.send_frames()
+            self.executor.shutdown()
@@ -0,0 +1,295 @@
+"""Load generator and measurements for benchmarking MQTT ingestion end to end."""
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+import paho.mqtt.client as mqtt
+from channels.layers import BaseChannelLayer
+from django.db import OperationalError, connections
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values`` (``fraction`` between 0 and 1)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, or None where unavailable."""
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class LatencyTracker:
+    """Match points seen in WebSocket frames to the time they were published."""
+
+    def __init__(self):
+        self._sent = {}
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.frames = 0
+        self.last_frame = None
+
+    def published(self, session_id, wavelength):
+        with self._lock:
+            self._sent[(session_id, wavelength)] = time.perf_counter()
+
+    def frame(self, session_id, wavelengths):
+        now = time.perf_counter()
+        with self._lock:
+            self.frames += 1
+            self.last_frame = now
+            for wavelength in wavelengths:
+                sent = self._sent.pop((session_id, wavelength), None)
+                if sent is not None:
+                    self.latencies.append(now - sent)
+
+    @property
+    def outstanding(self):
+        with self._lock:
+            return len(self._sent)
+
+
+class RecordingChannelLayer(BaseChannelLayer):
+    """Channel layer that records ``data_points`` frames instead of delivering them.
+
+    Configure it as the ``CHANNEL_LAYERS`` backend while benchmarking; the
+    tracker is shared through the class attribute.
+    """
+
+    tracker = None
+
+    def __init__(self, expiry=60, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+
+    async def group_send(self, group, message):
+        if self.tracker is None or message.get('type') != 'session_points':
+            return
+        frame = json.loads(message['text'])
+        self.tracker.frame(frame['session_id'], frame['wavelengths'])
+
+    async def group_add(self, group, channel):
+        pass
+
+    async def group_discard(self, group, channel):
+        pass
+
+    async def send(self, channel, message):
+        pass
+
+    async def new_channel(self, prefix='specific.'):
+        return f'{prefix}bench'
+
+
+class QueryCounter:
+    """Count SQL statements by verb on every connection opened while active.
+
+    Ingestion threads open their own connections, so the wrapper is attached
+    through ``connection_created`` as well as to connections already open.
+    Connections opened by threads named ``ignore_threads``-something are
+    left alone.
+    """
+
+    def __init__(self, ignore_threads=None):
+        self.ignore_threads = ignore_threads
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._wrapped = []
+
+    def __call__(self, execute, sql, params, many, context):
+        verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+        with self._lock:
+            self.counts[verb] += 1
+        return execute(sql, params, many, context)
+
+    def _attach(self, sender, connection, **kwargs):
+        if self.ignore_threads and threading.current_thread().name.startswith(self.ignore_threads):
+            return
+        connection.execute_wrappers.append(self)
+        self._wrapped.append(connection)
+
+    def __enter__(self):
+        connection_created.connect(self._attach)
+        for connection in connections.all():
+            if connection.connection is not None:
+                self._attach(None, connection)
+        return self
+
+    def __exit__(self, *exc):
+        connection_created.disconnect(self._attach)
+        for connection in self._wrapped:
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+    @property
+    def writes(self):
+        return sum(self.counts[verb] for verb in ('INSERT', 'UPDATE', 'DELETE'))
+
+
+class LoadGenerator:
+    """Simulate a device fleet publishing measurements over MQTT.
+
+    ``sessions`` is a list of ``(device_id, session_id)``; each device gets
+    its own client and thread and publishes its sessions in turn, every
+    session as ``points`` points split into messages of ``chunk`` points
+    (``chunk=1`` sends single-point payloads). ``rate`` caps messages per
+    second per device (0 for unlimited).
+    """
+
+    def __init__(self, host, port, sessions, points=1000, chunk=1000, rate=0, tracker=None, qos=1,
+                 max_in_flight=100):
+        self.host = host
+        self.port = port
+        self.points = points
+        self.chunk = chunk
+        self.rate = rate
+        self.tracker = tracker
+        self.qos = qos
+        self.max_in_flight = max_in_flight
+        self.by_device = {}
+        for device_id, session_id in sessions:
+            self.by_device.setdefault(device_id, []).append(session_id)
+        self.messages = 0
+        self.payload_bytes = 0
+        self._lock = threading.Lock()
+
+    def payloads(self, session_index):
+        """Yield (first_wavelength, payload) for one session's messages."""
+        for start in range(0, self.points, self.chunk):
+            stop = min(start + self.chunk, self.points)
+            wavelengths = [400.0 + index * 0.25 for index in range(start, stop)]
+            intensities = [float((index * 7919 + session_index) % 1000) for index in range(start, stop)]
+            if self.chunk == 1:
+                data = {'wavelength': wavelengths[0], 'intensity': intensities[0]}
+            else:
+                data = {'wavelengths': wavelengths, 'intensities': intensities}
+            yield wavelengths[0], json.dumps(data).encode()
+
+    def run_device(self, device_id, session_ids):
+        client = mqtt.Client()
+        client.connect(self.host, self.port)
+        client.loop_start()
+        interval = 1.0 / self.rate if self.rate else 0
+        in_flight = []
+        try:
+            for session_index, session_id in enumerate(session_ids):
+                topic = f'{device_id}/{session_id}/measurements'
+                for first_wavelength, payload in self.payloads(session_index):
+                    if self.tracker:
+                        self.tracker.published(session_id, first_wavelength)
+                    info = client.publish(topic, payload, qos=self.qos)
+                    with self._lock:
+                        self.messages += 1
+                        self.payload_bytes += len(payload)
+                    if interval:
+                        time.sleep(interval)
+                    elif self.qos:
+                        # Keep at most max_in_flight unacknowledged messages per device
+                        in_flight.append(info)
+                        if len(in_flight) > self.max_in_flight:
+                            in_flight.pop(0).wait_for_publish(timeout=10)
+            for info in in_flight:
+                info.wait_for_publish(timeout=10)
+        finally:
+            client.disconnect()
+            client.loop_stop()
+
+    def run(self):
+        threads = [
+            threading.Thread(target=self.run_device, args=(device_id, session_ids), daemon=True)
+            for device_id, session_ids in self.by_device.items()
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+class WebLoad:
+    """Run web-like database traffic from threads while ingestion writes.
+
+    Each thread loops until ``stop``: it lists the latest sessions with
+    their patients and devices, loads one session's spectrum and, every
+    ``write_every`` loops, updates that session as starting or stopping a
+    measurement does. "database is locked" errors are counted, not raised.
+    """
+
+    thread_name = 'web-load'
+
+    def __init__(self, session_ids, threads=2, write_every=10):
+        from .models import MeasurementSession, Spectrum
+
+        self.session_model = MeasurementSession
+        self.spectrum_model = Spectrum
+        self.session_ids = session_ids
+        self.write_every = write_every
+        self.latencies = []
+        self.writes = 0
+        self.lock_errors = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = [
+            threading.Thread(target=self.run_thread, name=f'{self.thread_name}-{index}', daemon=True)
+            for index in range(threads)
+        ]
+
+    def run_thread(self):
+        rng = random.Random()
+        loops = 0
+        try:
+            while not self._stop.is_set():
+                loops += 1
+                session_id = rng.choice(self.session_ids)
+                started = time.perf_counter()
+                try:
+                    list(self.session_model.objects.select_related('patient', 'device')[:20])
+                    self.spectrum_model.objects.filter(session__session_id=session_id).first()
+                    if loops % self.write_every == 0:
+                        self.session_model.objects.filter(session_id=session_id).update(updated_at=timezone.now())
+                        with self._lock:
+                            self.writes += 1
+                except OperationalError as e:
+                    if 'locked' not in str(e):
+                        raise
+                    with self._lock:
+                        self.lock_errors += 1
+                    continue
+                with self._lock:
+                    self.latencies.append(time.perf_counter() - started)
+        finally:
+            connections.close_all()
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+
+def database_size(alias='default'):
+    """Bytes on disk for an SQLite database (including its WAL), else None."""
+    connection = connections[alias]
+    if connection.vendor != 'sqlite':
+        return None
+    name = str(connection.settings_dict['NAME'])
+    if name == ':memory:' or 'mode=memory' in name:
+        return None
+    return sum(os.path.getsize(path) for path in (name, f'{name}-wal') if os.path.exists(path))
@@ -0,0 +1,239 @@
+"""Minimal in-process MQTT 3.1.1 broker for local development and tests.
+
+It speaks just enough of the protocol for ``run_mqtt`` and paho publishers:
+CONNECT, SUBSCRIBE/UNSUBSCRIBE with ``+``/``#`` wildcards and
+``$share/<group>/`` shared subscriptions, PUBLISH at QoS 0-2, PINGREQ and
+DISCONNECT. Nothing is persisted and retained messages, wills and
+authentication are ignored. Do not expose it outside localhost.
+"""
+import asyncio
+import itertools
+import logging
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def topic_matches(topic_filter, topic):
+    """Return True if ``topic`` matches an MQTT subscription filter."""
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    data = value.encode()
+    return struct.pack('!H', len(data)) + data
+
+
+def packet(packet_type, body=b'', flags=0):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+class Connection:
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.client_id = ''
+        self.subscriptions = set()
+        self._packet_ids = itertools.cycle(range(1, 65536))
+
+    def send(self, data):
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    def deliver(self, topic, payload, qos):
+        header = encode_string(topic)
+        if qos:
+            header += struct.pack('!H', next(self._packet_ids))
+        self.send(packet(PUBLISH, header + payload, flags=qos << 1))
+
+    async def read_packet(self):
+        first = (await self.reader.readexactly(1))[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await self.reader.readexactly(length) if length else b''
+        return first >> 4, first & 0x0F, body
+
+    async def run(self):
+        try:
+            while True:
+                packet_type, flags, body = await self.read_packet()
+                if packet_type == DISCONNECT:
+                    break
+                self.handle(packet_type, flags, body)
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.broker.disconnected(self)
+            self.writer.close()
+
+    def handle(self, packet_type, flags, body):
+        if packet_type == CONNECT:
+            # Skip protocol name, level, flags and keepalive to reach the client id
+            offset = 2 + struct.unpack('!H', body[:2])[0] + 4
+            size = struct.unpack('!H', body[offset:offset + 2])[0]
+            self.client_id = body[offset + 2:offset + 2 + size].decode()
+            self.send(packet(CONNACK, b'\x00\x00'))
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            size = struct.unpack('!H', body[:2])[0]
+            topic = body[2:2 + size].decode()
+            offset = 2 + size
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                self.send(packet(PUBACK if qos == 1 else PUBREC, packet_id))
+            self.broker.publish(topic, body[offset:], qos)
+        elif packet_type == PUBREL:
+            self.send(packet(PUBCOMP, body[:2]))
+        elif packet_type == SUBSCRIBE:
+            packet_id, offset, granted = body[:2], 2, bytearray()
+            while offset < len(body):
+                size = struct.unpack('!H', body[offset:offset + 2])[0]
+                topic_filter = body[offset + 2:offset + 2 + size].decode()
+                qos = min(body[offset + 2 + size], 1)
+                offset += 3 + size
+                self.broker.subscribe(self, topic_filter, qos)
+                granted.append(qos)
+            self.send(packet(SUBACK, packet_id + bytes(granted)))
+        elif packet_type == UNSUBSCRIBE:
+            packet_id, offset = body[:2], 2
+            while offset < len(body):
+                size = struct.unpack('!H', body[offset:offset + 2])[0]
+                self.broker.unsubscribe(self, body[offset + 2:offset + 2 + size].decode())
+                offset += 2 + size
+            self.send(packet(UNSUBACK, packet_id))
+        elif packet_type == PINGREQ:
+            self.send(packet(PINGRESP))
+        # PUBACK/PUBREC/PUBCOMP from subscribers need no reply at QoS <= 1
+
+
+class LocalBroker:
+    """Route messages between local MQTT clients.
+
+    ``start`` runs the broker on a background thread and returns once it is
+    listening (``port=0`` picks a free port, available as ``port``);
+    ``serve_forever`` runs it in the calling thread. ``published`` counts
+    messages received from publishers.
+    """
+
+    def __init__(self, host='127.0.0.1', port=1883):
+        self.host = host
+        self.port = port
+        self.published = 0
+        self._connections = set()
+        # (filter, qos) per connection, and round-robin cursors for shared groups
+        self._subscriptions = {}
+        self._shared = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def subscribe(self, connection, topic_filter, qos):
+        if topic_filter.startswith('$share/'):
+            _, group, shared_filter = topic_filter.split('/', 2)
+            members = self._shared.setdefault((group, shared_filter), [])
+            if connection not in [member for member, _ in members]:
+                members.append((connection, qos))
+        else:
+            self._subscriptions.setdefault(connection, {})[topic_filter] = qos
+        connection.subscriptions.add(topic_filter)
+
+    def unsubscribe(self, connection, topic_filter):
+        connection.subscriptions.discard(topic_filter)
+        if topic_filter.startswith('$share/'):
+            _, group, shared_filter = topic_filter.split('/', 2)
+            members = self._shared.get((group, shared_filter), [])
+            members[:] = [(member, qos) for member, qos in members if member is not connection]
+        else:
+            self._subscriptions.get(connection, {}).pop(topic_filter, None)
+
+    def disconnected(self, connection):
+        self._connections.discard(connection)
+        self._subscriptions.pop(connection, None)
+        for members in self._shared.values():
+            members[:] = [(member, qos) for member, qos in members if member is not connection]
+
+    def publish(self, topic, payload, qos=0):
+        self.published += 1
+        for connection, filters in list(self._subscriptions.items()):
+            matched = [sub_qos for topic_filter, sub_qos in filters.items() if topic_matches(topic_filter, topic)]
+            if matched:
+                connection.deliver(topic, payload, min(qos, max(matched)))
+        for (group, shared_filter), members in self._shared.items():
+            if members and topic_matches(shared_filter, topic):
+                # Rotate so each message goes to exactly one group member
+                member, sub_qos = members.pop(0)
+                members.append((member, sub_qos))
+                member.deliver(topic, payload, min(qos, sub_qos))
+
+    async def _handle(self, reader, writer):
+        connection = Connection(self, reader, writer)
+        self._connections.add(connection)
+        await connection.run()
+
+    async def _serve(self, ready=None):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        if ready:
+            ready.set()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def serve_forever(self, ready=None):
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._loop.run_until_complete(self._serve(ready))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+
+    def start(self):
+        ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self.serve_forever, args=(ready,), name='local-mqtt-broker', daemon=True
+        )
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def _close(self):
+        for connection in list(self._connections):
+            connection.writer.close()
+        self._server.close()
+
+    def stop(self):
+        if self._loop and self._server and not self._loop.is_closed():
+            # One callback, so the loop cannot close between the server and its connections
+            self._loop.call_soon_threadsafe(self._close)
+        if self._thread:
+            self._thread.join(timeout=5)
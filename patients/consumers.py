@@ -1,8 +1,54 @@
+import asyncio
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from .models import MeasurementSession
 
+# Seconds a session's status is shared between all sockets watching it
+STATUS_CACHE_TIMEOUT = 2
+
+# Status reads in flight in this process, so concurrent misses share one query
+_status_loads = {}
+
+@database_sync_to_async
+def read_session_status(session_id):
+    try:
+        row = MeasurementSession.objects.filter(session_id=session_id).values(
+            'status', 'spectrum__point_count'
+        ).first()
+    except ValidationError:
+        # Not a UUID, so not a session
+        return None
+    if row is None:
+        return None
+    point_count = row['spectrum__point_count'] or 0
+    return {'status': row['status'], 'point_count': point_count, 'has_data': point_count > 0}
+
+async def get_session_status(session_id):
+    """Return a session's status, reading the database at most once per timeout.
+
+    The result is kept in the Django cache for STATUS_CACHE_TIMEOUT seconds
+    (process-local by default, shared if a shared backend is configured).
+    Returns None for unknown sessions.
+    """
+    key = f'session_status:{session_id}'
+    status = await cache.aget(key)
+    if status is not None:
+        return status
+    load = _status_loads.get(session_id)
+    if load is None:
+        async def load_and_cache():
+            status = await read_session_status(session_id)
+            if status is not None:
+                await cache.aset(key, status, STATUS_CACHE_TIMEOUT)
+            return status
+        load = _status_loads[session_id] = asyncio.ensure_future(load_and_cache())
+        load.add_done_callback(lambda _: _status_loads.pop(session_id, None))
+    # Shielded so one socket disconnecting does not cancel the read for the others
+    return await asyncio.shield(load)
+
 class SessionConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.session_id = self.scope['url_route']['kwargs']['session_id']
@@ -17,13 +63,13 @@ class SessionConsumer(AsyncWebsocketConsumer):
         await self.accept()
 
         # Send current session status
-        session = await self.get_session()
-        if session:
+        status = await get_session_status(self.session_id)
+        if status:
             await self.send(text_data=json.dumps({
                 'type': 'session_update',
-                'session_id': str(session.session_id),
-                'status': session.status,
-                'point_count': await self.get_point_count(session)
+                'session_id': self.session_id,
+                'status': status['status'],
+                'point_count': status['point_count']
             }))
 
     async def disconnect(self, close_code):
@@ -38,20 +84,14 @@ class SessionConsumer(AsyncWebsocketConsumer):
         message = data.get('message')
         
         if message == 'update_status':
-            # Get the latest session status
-            try:
-                session = MeasurementSession.objects.get(session_id=self.session_id)
-                # Send updated status to the group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'status_update',
-                        'status': session.status,
-                        'has_data': session.spectra.exists()
-                    }
-                )
-            except MeasurementSession.DoesNotExist:
-                pass
+            # Answer only the asking socket; every open tab polls on its own timer
+            status = await get_session_status(self.session_id)
+            if status:
+                await self.send(text_data=json.dumps({
+                    'type': 'status_update',
+                    'status': status['status'],
+                    'has_data': status['has_data']
+                }))
         elif message:
             # Handle regular messages
             await self.channel_layer.group_send(
@@ -78,17 +118,10 @@ class SessionConsumer(AsyncWebsocketConsumer):
             'has_data': event['has_data']
         }))
 
+    async def session_points(self, event):
+        # Frames of new points arrive already encoded by the ingestion process
+        await self.send(text_data=event['text'])
+
     async def session_update(self, event):
         # Send message to WebSocket
         await self.send(text_data=json.dumps(event))
-
-    @database_sync_to_async
-    def get_session(self):
-        try:
-            return MeasurementSession.objects.get(session_id=self.session_id)
-        except MeasurementSession.DoesNotExist:
-            return None
-
-    @database_sync_to_async
-    def get_point_count(self, session):
-        return session.spectra.count()
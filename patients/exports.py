@@ -0,0 +1,180 @@
+"""Streaming writers for exporting spectral data."""
+import csv
+import io
+import zipfile
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+
+from .models import MeasurementSession, Spectrum
+
+# Rows formatted per chunk handed to the response
+EXPORT_CHUNK_SIZE = 2000
+
+
+class Echo:
+    """File-like object that returns what is written instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(wavelengths, intensities, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield a spectrum as encoded CSV, one chunk of rows at a time.
+
+    Only ``chunk_size`` rows are turned into Python objects at once, so memory
+    use does not grow with the size of the spectrum.
+    """
+    writer = csv.writer(Echo(), lineterminator='\n')
+    yield writer.writerow(['wavelength', 'intensity']).encode()
+    for start in range(0, len(wavelengths), chunk_size):
+        stop = start + chunk_size
+        rows = zip(wavelengths[start:stop].tolist(), intensities[start:stop].tolist())
+        yield ''.join(writer.writerow(row) for row in rows).encode()
+
+
+def accepts_gzip(request):
+    return 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+
+
+def response_chunks(request, chunks):
+    """Return ``chunks`` in the form the serving handler can stream.
+
+    Django buffers a sync iterator in full before sending it under ASGI, so
+    ASGI requests get an async iterator that produces each chunk in the sync
+    thread (where the view and its database connection live) as it is sent.
+    """
+    if not isinstance(request, ASGIRequest):
+        return chunks
+    return _aiter_chunks(iter(chunks))
+
+
+_DONE = object()
+
+
+async def _aiter_chunks(iterator):
+    pull = sync_to_async(next)
+    while (chunk := await pull(iterator, _DONE)) is not _DONE:
+        yield chunk
+
+
+
+class StreamSink(io.RawIOBase):
+    """Write-only, unseekable file that hands its contents out through ``drain``.
+
+    Archive writers write into it and the caller forwards whatever has
+    accumulated after each step, so nothing larger than one step is held.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def filter_sessions(patient=None, device=None, start=None, end=None, status=None):
+    """Return sessions matching the given patient ID, device ID, dates and status."""
+    sessions = MeasurementSession.objects.all()
+    if patient:
+        sessions = sessions.filter(patient__patient_id=patient)
+    if device:
+        sessions = sessions.filter(device__device_id=device)
+    if start:
+        sessions = sessions.filter(created_at__date__gte=start)
+    if end:
+        sessions = sessions.filter(created_at__date__lte=end)
+    if status:
+        sessions = sessions.filter(status=status)
+    return sessions
+
+
+def iter_spectra(sessions, chunk_size=50):
+    """Iterate the spectra of ``sessions`` oldest first, ``chunk_size`` rows at a time."""
+    return (
+        Spectrum.objects.filter(session__in=sessions)
+        .select_related('session', 'session__patient', 'session__device')
+        .order_by('session__created_at', 'pk')
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def iter_zip(spectra):
+    """Yield a ZIP archive holding one CSV file per session."""
+    sink = StreamSink()
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for spectrum in spectra:
+            wavelengths, intensities = spectrum.as_arrays()
+            name = f'session_{spectrum.session.session_id}.csv'
+            with archive.open(name, mode='w', force_zip64=True) as entry:
+                for chunk in iter_csv(wavelengths, intensities):
+                    entry.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+def iter_parquet(spectra):
+    """Return an iterator over a single Parquet file, one row group per session.
+
+    Requires ``pyarrow``; raises ``ImportError`` straight away, before any
+    output is produced, if it is not installed.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    label = pa.dictionary(pa.int32(), pa.string())
+    schema = pa.schema([
+        ('session_id', label),
+        ('patient_id', label),
+        ('device_id', label),
+        ('wavelength', pa.float64()),
+        ('intensity', pa.float64()),
+    ])
+
+    def repeated(value, count):
+        return pa.DictionaryArray.from_arrays(
+            pa.array(np.zeros(count, dtype=np.int32)), pa.array([value], type=pa.string())
+        )
+
+    def chunks():
+        sink = StreamSink()
+        with pq.ParquetWriter(sink, schema) as writer:
+            for spectrum in spectra:
+                session = spectrum.session
+                wavelengths, intensities = spectrum.as_arrays()
+                count = wavelengths.size
+                writer.write_table(pa.Table.from_arrays([
+                    repeated(str(session.session_id), count),
+                    repeated(session.patient.patient_id if session.patient else None, count),
+                    repeated(session.device.device_id if session.device else None, count),
+                    pa.array(wavelengths.astype(np.float64, copy=False)),
+                    pa.array(intensities.astype(np.float64, copy=False)),
+                ], schema=schema))
+                yield sink.drain()
+        yield sink.drain()
+
+    return chunks()
+
+
+EXPORT_FORMATS = {
+    'zip': (iter_zip, 'application/zip', 'zip'),
+    'parquet': (iter_parquet, 'application/vnd.apache.parquet', 'parquet'),
+}
@@ -6,6 +6,9 @@ from django.core.exceptions import ValidationError
 
 User = get_user_model()
 
+# Oldest age accepted for a patient, matching the age input's max
+MAX_AGE = 150
+
 class PatientForm(forms.ModelForm):
     date_of_birth = forms.DateField(
         required=False,
@@ -40,16 +43,24 @@ class PatientForm(forms.ModelForm):
     def save(self, commit=True):
         instance = super().save(commit=False)
         
-        # Only generate a new patient ID for new instances
-        if not instance.patient_id:
-            instance.patient_id = generate_patient_id()
-            
+        # New instances get their patient ID from the sequence in Patient.save()
         if commit:
             instance.save()
             self.save_m2m()
             
         return instance
 
+    def clean_date_of_birth(self):
+        date_of_birth = self.cleaned_data.get('date_of_birth')
+        if date_of_birth:
+            from datetime import date
+            today = date.today()
+            if date_of_birth > today:
+                raise forms.ValidationError("Date of birth cannot be in the future")
+            if today.year - date_of_birth.year > MAX_AGE:
+                raise forms.ValidationError(f"Date of birth cannot be more than {MAX_AGE} years ago")
+        return date_of_birth
+
     def clean_phone_number(self):
         phone_number = self.cleaned_data.get('phone_number')
         # Add any phone number validation here
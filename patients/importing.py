@@ -0,0 +1,132 @@
+"""Bulk import of patient records from CSV or XLSX files."""
+import csv
+import io
+from datetime import date
+from itertools import islice
+
+import pandas as pd
+from django.db import IntegrityError, transaction
+
+from .forms import PatientForm
+from .models import Patient, reserve_patient_ids
+
+IMPORT_FIELDS = PatientForm.Meta.fields
+
+
+def read_csv(file):
+    """Yield one dict per CSV row; ``file`` may be text or binary."""
+    if isinstance(file, io.TextIOBase):
+        text = file
+    else:
+        text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    yield from csv.DictReader(text)
+
+
+def read_xlsx(file):
+    """Yield one dict per row of the first sheet, using the first row as headers."""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        headers = [str(header).strip() if header is not None else '' for header in next(rows, ())]
+        for values in rows:
+            yield dict(zip(headers, values))
+    finally:
+        workbook.close()
+
+
+READERS = {
+    'csv': read_csv,
+    'xlsx': read_xlsx,
+}
+
+
+def ages_on(birth_dates, today=None):
+    """Return ages in whole years for a sequence of dates, computed in one pass."""
+    today = today or date.today()
+    born = pd.to_datetime(pd.Series(birth_dates))
+    not_had_birthday = (born.dt.month > today.month) | (
+        (born.dt.month == today.month) & (born.dt.day > today.day)
+    )
+    return (today.year - born.dt.year - not_had_birthday.astype(int)).tolist()
+
+
+class PatientImporter:
+    """Validate patient rows with PatientForm and write them in batches.
+
+    Each batch of ``batch_size`` valid rows is written with one
+    ``bulk_create`` inside its own transaction, after its patient IDs are
+    reserved in a single step. Invalid rows are collected in ``errors`` as
+    ``(row_number, message)`` and never stop the import; if the database
+    rejects a batch, its rows are retried one at a time so only the
+    offending rows are reported. ``on_batch`` is
+    called with the importer after every batch for progress reporting.
+    """
+
+    def __init__(self, batch_size=1000, on_batch=None):
+        self.batch_size = batch_size
+        self.on_batch = on_batch
+        self.imported = 0
+        self.errors = []
+
+    def run(self, rows):
+        # Row 1 holds the headers, so data starts at row 2
+        numbered = enumerate(rows, start=2)
+        while True:
+            chunk = list(islice(numbered, self.batch_size))
+            if not chunk:
+                break
+            self.write_batch(self.validate(chunk))
+            if self.on_batch:
+                self.on_batch(self)
+        return self
+
+    def validate(self, chunk):
+        """Return ``(row_number, patient)`` for the valid rows of ``chunk``."""
+        patients = []
+        for row_number, row in chunk:
+            data = {
+                field: '' if row.get(field) is None else row.get(field)
+                for field in IMPORT_FIELDS
+            }
+            form = PatientForm(data=data)
+            if form.is_valid():
+                patients.append((row_number, form.save(commit=False)))
+            else:
+                message = '; '.join(
+                    f'{field}: {" ".join(messages)}' for field, messages in form.errors.items()
+                )
+                self.errors.append((row_number, message))
+        return patients
+
+    def write_batch(self, rows):
+        if not rows:
+            return
+        patients = [patient for _, patient in rows]
+        # bulk_create skips Patient.save(), so derive ages and IDs here
+        missing_age = [patient for patient in patients if patient.date_of_birth and not patient.age]
+        if missing_age:
+            ages = ages_on([patient.date_of_birth for patient in missing_age])
+            for patient, age in zip(missing_age, ages):
+                patient.age = age
+        for patient, patient_id in zip(patients, reserve_patient_ids(len(patients))):
+            patient.patient_id = patient_id
+
+        try:
+            with transaction.atomic():
+                Patient.objects.bulk_create(patients)
+        except IntegrityError:
+            self.write_each(rows)
+        else:
+            self.imported += len(patients)
+
+    def write_each(self, rows):
+        for row_number, patient in rows:
+            try:
+                with transaction.atomic():
+                    Patient.objects.bulk_create([patient])
+            except IntegrityError as exc:
+                self.errors.append((row_number, f'database: {exc}'))
+            else:
+                self.imported += 1
@@ -0,0 +1,428 @@
+"""Buffered persistence of spectral points received over MQTT."""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from . import metrics
+from .models import Device, MeasurementSession, Spectrum
+
+logger = logging.getLogger(__name__)
+
+
+def reconcile_session_status(idle_timeout=None):
+    """Mark in-progress sessions whose data stopped arriving as completed.
+
+    Ingestion completes sessions once they go idle or the device ends the
+    scan; this catches any left behind (e.g. data loaded by other means)
+    with one set-based ``UPDATE``. Only sessions whose spectrum has not
+    changed for ``idle_timeout`` seconds (``MQTT['SESSION_IDLE_TIMEOUT']``
+    by default) are touched, so a scan still in progress is left open.
+    Returns the number of sessions updated.
+    """
+    if idle_timeout is None:
+        idle_timeout = settings.MQTT.get('SESSION_IDLE_TIMEOUT', 30.0)
+    now = timezone.now()
+    idle_data = Spectrum.objects.filter(
+        session=OuterRef('pk'), point_count__gt=0, updated_at__lt=now - timedelta(seconds=idle_timeout)
+    )
+    return MeasurementSession.objects.filter(status='in_progress').filter(
+        Exists(idle_data)
+    ).update(status='completed', updated_at=now)
+
+
+def backfill_spectrum_summaries(recompute=False, batch_size=200):
+    """Compute the summary fields of spectra that hold points but have none.
+
+    With ``recompute`` every non-empty spectrum is recomputed. Spectra are
+    read in batches and each batch is written in one transaction. A row is
+    only updated if its revision is unchanged, so a summary computed from
+    arrays that ingestion has since extended is discarded (ingestion keeps
+    the summary of the rows it writes). Returns the number of spectra updated.
+    """
+    spectra = Spectrum.objects.filter(point_count__gt=0).only('pk', 'dtype', 'revision', 'wavelengths', 'intensities')
+    if not recompute:
+        spectra = spectra.filter(intensity_mean__isnull=True)
+
+    def save(batch):
+        with transaction.atomic():
+            return sum(
+                Spectrum.objects.filter(pk=spectrum.pk, revision=spectrum.revision).update(
+                    **{name: getattr(spectrum, name) for name in Spectrum.SUMMARY_FIELDS}
+                )
+                for spectrum in batch
+            )
+
+    updated = 0
+    batch = []
+    for spectrum in spectra.order_by('pk').iterator(chunk_size=batch_size):
+        spectrum.recompute_summary()
+        batch.append(spectrum)
+        if len(batch) >= batch_size:
+            updated += save(batch)
+            batch = []
+    if batch:
+        updated += save(batch)
+    return updated
+
+
+class LookupCache:
+    """Bounded LRU cache whose entries expire ``ttl`` seconds after loading.
+
+    Misses call ``loader(key)``; exceptions it raises (such as
+    ``DoesNotExist``) propagate and nothing is cached. The expiry bounds how
+    long a change made in another process can go unnoticed; changes made in
+    this process are dropped straight away through ``invalidate``.
+    """
+
+    def __init__(self, loader, max_size=1024, ttl=30.0):
+        self.loader = loader
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+        value = self.loader(key)
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+device_cache = LookupCache(
+    lambda device_id: Device.objects.get(device_id=device_id, is_active=True),
+    max_size=settings.MQTT.get('CACHE_SIZE', 1024),
+    ttl=settings.MQTT.get('CACHE_TTL', 30.0),
+)
+session_cache = LookupCache(
+    lambda session_id: MeasurementSession.objects.get(session_id=session_id),
+    max_size=settings.MQTT.get('CACHE_SIZE', 1024),
+    ttl=settings.MQTT.get('CACHE_TTL', 30.0),
+)
+
+
+def device_timestamp(value):
+    """Return a payload ``timestamp`` as epoch seconds, or None if unusable.
+
+    Devices may send epoch seconds, epoch milliseconds or an ISO 8601 string;
+    naive strings are taken as UTC.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        # Anything this large is milliseconds (seconds would be past year 5000)
+        return value / 1000 if value > 1e11 else float(value)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=dt_timezone.utc)
+        return parsed.timestamp()
+    return None
+
+
+def complete_sessions(sessions):
+    """Mark ``(pk, session_id)`` pairs completed and drop them from the lookup cache.
+
+    Only sessions still in progress are updated; returns how many were.
+    """
+    sessions = list(sessions)
+    if not sessions:
+        return 0
+    updated = MeasurementSession.objects.filter(
+        pk__in=[pk for pk, _ in sessions], status='in_progress'
+    ).update(status='completed', updated_at=timezone.now())
+    for _, session_id in sessions:
+        session_cache.invalidate(str(session_id))
+    return updated
+
+
+class IdleSessionSweeper:
+    """Complete sessions that have received no new points for ``idle_timeout`` seconds.
+
+    Ingestion calls ``touch`` with the sessions each flush wrote to, and
+    ``sweep`` (run every ``interval`` seconds, see ``is_due``) compares them
+    with their spectrum's ``updated_at``, so writes made by other workers
+    count as activity too. ``sweep(everything=True)`` checks every
+    in-progress session instead, catching those a previous run left behind.
+    """
+
+    def __init__(self, idle_timeout=30.0, interval=None):
+        self.idle_timeout = idle_timeout
+        self.interval = interval if interval is not None else max(1.0, idle_timeout / 4)
+        self._active = set()
+        self._lock = threading.Lock()
+        self._next = time.monotonic() + self.interval
+
+    def touch(self, sessions):
+        with self._lock:
+            self._active.update(session.pk for session in sessions)
+
+    def is_due(self):
+        return time.monotonic() >= self._next
+
+    def sweep(self, everything=False):
+        """Complete idle sessions and return how many were completed."""
+        self._next = time.monotonic() + self.interval
+        cutoff = timezone.now() - timedelta(seconds=self.idle_timeout)
+        sessions = MeasurementSession.objects.filter(status='in_progress', spectrum__point_count__gt=0)
+        if not everything:
+            with self._lock:
+                active = list(self._active)
+            if not active:
+                return 0
+            # Forget sessions that were completed or deleted elsewhere
+            live = set(sessions.filter(pk__in=active).values_list('pk', flat=True))
+            with self._lock:
+                self._active -= set(active) - live
+            sessions = sessions.filter(pk__in=live)
+        idle = list(sessions.filter(spectrum__updated_at__lt=cutoff).values_list('pk', 'session_id'))
+        with self._lock:
+            self._active -= {pk for pk, _ in idle}
+        return complete_sessions(idle)
+
+
+def persist_points(batch):
+    """Write a batch of ``(session, wavelengths, intensities)`` chunks.
+
+    Chunks for the same session are concatenated and merged into that
+    session's packed ``Spectrum`` in one write, with the row locked so that
+    concurrent consumers cannot lose each other's points. Wavelengths already
+    stored (and repeats inside the batch) are skipped; the first value seen
+    wins. Session status is left alone; see ``IdleSessionSweeper``.
+    Chunks for sessions deleted since they were looked up (the lookup cache
+    can still hold them) are dropped and those sessions evicted from it.
+    Returns a dict mapping the sessions that received at least one new point
+    to their updated ``Spectrum``; the points this write added are
+    ``spectrum.since(spectrum.revision - 1)``.
+    """
+    by_session = {}
+    for session, wavelengths, intensities in batch:
+        _, chunks = by_session.setdefault(session.pk, (session, []))
+        chunks.append((wavelengths, intensities))
+
+    live = set(MeasurementSession.objects.filter(pk__in=list(by_session)).values_list('pk', flat=True))
+    for session_pk in set(by_session) - live:
+        session, chunks = by_session.pop(session_pk)
+        session_cache.invalidate(str(session.session_id))
+        metrics.mqtt_rejected.inc(len(chunks), reason='unknown_session')
+        logger.warning('Dropped %d chunk(s) for session %s, which no longer exists', len(chunks), session.session_id)
+
+    written = {}
+    offered = persisted = 0
+    if not by_session:
+        return written
+    with transaction.atomic():
+        # The unique session index turns a concurrent create into a no-op,
+        # so every session is guaranteed a row to lock and merge into
+        Spectrum.objects.bulk_create(
+            [Spectrum(session=session) for session, _ in by_session.values()],
+            ignore_conflicts=True,
+        )
+        spectra = {
+            spectrum.session_id: spectrum
+            for spectrum in Spectrum.objects.select_for_update().filter(session_id__in=list(by_session))
+        }
+        for session_pk, (session, chunks) in by_session.items():
+            spectrum = spectra[session_pk]
+            wavelengths = np.concatenate([np.asarray(wavelengths, dtype=np.float64) for wavelengths, _ in chunks])
+            added = spectrum.append(
+                wavelengths,
+                np.concatenate([np.asarray(intensities, dtype=np.float64) for _, intensities in chunks]),
+            )
+            offered += wavelengths.size
+            persisted += added
+            if added:
+                spectrum.save()
+                written[session] = spectrum
+
+    metrics.mqtt_points_persisted.inc(persisted)
+    metrics.mqtt_points_duplicate.inc(offered - persisted)
+    return written
+
+
+class SpectralBuffer:
+    """Collect spectral points in memory and flush them in batches.
+
+    A flush happens as soon as ``max_points`` points are pending or the oldest
+    pending point has waited ``max_delay`` seconds, whichever comes first. The
+    size check runs on every ``add``; the time check is up to the caller, who
+    should poll ``is_due`` from its own loop. ``on_flush`` is called with the
+    result of ``persist_points`` after every non-empty flush.
+
+    Points may carry ``sent_at``, the device's timestamp in epoch seconds;
+    each flush records how long after it the points were written.
+    """
+
+    def __init__(self, max_points=500, max_delay=1.0, on_flush=None):
+        self.max_points = max_points
+        self.max_delay = max_delay
+        self.on_flush = on_flush
+        self._pending = []
+        self._pending_points = 0
+        self._sent_at = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return self._pending_points
+
+    def _queue(self, session, wavelengths, intensities, sent_at):
+        with self._lock:
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append((session, wavelengths, intensities))
+            self._pending_points += len(wavelengths)
+            if sent_at is not None:
+                self._sent_at.append(sent_at)
+            return self._pending_points >= self.max_points
+
+    def add(self, session, wavelength, intensity, sent_at=None):
+        """Queue one point, flushing straight away if the buffer is full."""
+        if self._queue(session, (wavelength,), (intensity,), sent_at):
+            self.flush()
+
+    def extend(self, session, wavelengths, intensities, sent_at=None):
+        """Queue a whole spectrum and write it out in one batch."""
+        self._queue(session, wavelengths, intensities, sent_at)
+        return self.flush()
+
+    def is_due(self):
+        """Return True if the oldest pending point has waited long enough."""
+        with self._lock:
+            return bool(self._pending) and time.monotonic() - self._oldest >= self.max_delay
+
+    def flush(self):
+        """Persist everything pending and return the sessions written to."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                sent_at, self._sent_at = self._sent_at, []
+                self._pending_points = 0
+                self._oldest = None
+            if not batch:
+                return {}
+            started = time.perf_counter()
+            try:
+                written = persist_points(batch)
+            except IntegrityError:
+                # A session was deleted mid-write; retry per session so the rest are kept
+                written = self._persist_each(batch)
+            metrics.mqtt_db_write.observe(time.perf_counter() - started)
+            now = time.time()
+            for timestamp in sent_at:
+                metrics.mqtt_lag.observe(max(0.0, now - timestamp))
+            if written and self.on_flush:
+                self.on_flush(written)
+            return written
+
+
+    def _persist_each(self, batch):
+        by_session = {}
+        for chunk in batch:
+            by_session.setdefault(chunk[0].pk, []).append(chunk)
+        written = {}
+        for chunks in by_session.values():
+            try:
+                written.update(persist_points(chunks))
+            except IntegrityError as e:
+                session = chunks[0][0]
+                session_cache.invalidate(str(session.session_id))
+                metrics.mqtt_rejected.inc(len(chunks), reason='unknown_session')
+                logger.warning('Dropped %d chunk(s) for session %s: %s', len(chunks), session.session_id, e)
+        return written
+
+
+class FrameCoalescer:
+    """Merge new points per session and release them as WebSocket frames.
+
+    ``push`` only queues; ``release`` (called from the owner's loop) sends
+    each session's queued points once ``interval`` seconds have passed since
+    its previous frame, split into frames of at most ``max_points``. Frames
+    are JSON-encoded once here and handed to ``send(session_id, text)``.
+    """
+
+    def __init__(self, send, interval=0.25, max_points=5000):
+        self.send = send
+        self.interval = interval
+        self.max_points = max_points
+        self._pending = {}
+        self._last_sent = {}
+        self._lock = threading.Lock()
+
+    def push(self, session_id, spectrum, wavelengths, intensities):
+        """Queue the points a write added to ``spectrum``."""
+        with self._lock:
+            entry = self._pending.setdefault(session_id, {
+                'since': spectrum.revision - 1,
+                'wavelengths': [],
+                'intensities': [],
+            })
+            entry['revision'] = spectrum.revision
+            entry['point_count'] = spectrum.point_count
+            entry['wavelengths'].append(wavelengths)
+            entry['intensities'].append(intensities)
+
+    def release(self, force=False):
+        """Send frames for every session that is due, or all of them if ``force``."""
+        now = time.monotonic()
+        with self._lock:
+            due = [
+                session_id for session_id in self._pending
+                if force or now - self._last_sent.get(session_id, float('-inf')) >= self.interval
+            ]
+            entries = [(session_id, self._pending.pop(session_id)) for session_id in due]
+            # Sessions idle for a whole interval no longer need throttling
+            self._last_sent = {
+                session_id: sent for session_id, sent in self._last_sent.items()
+                if now - sent < self.interval
+            }
+            self._last_sent.update((session_id, now) for session_id in due)
+
+        for session_id, entry in entries:
+            wavelengths = np.concatenate(entry['wavelengths'])
+            intensities = np.concatenate(entry['intensities'])
+            for start in range(0, wavelengths.size, self.max_points):
+                stop = start + self.max_points
+                self.send(session_id, json.dumps({
+                    'type': 'data_points',
+                    'session_id': str(session_id),
+                    'since': entry['since'],
+                    'revision': entry['revision'],
+                    'point_count': entry['point_count'],
+                    'wavelengths': wavelengths[start:stop].tolist(),
+                    'intensities': intensities[start:stop].tolist(),
+                }))
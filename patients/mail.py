@@ -0,0 +1,150 @@
+"""Database-backed email outbox, drained by the send_queued_mail worker."""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import F, Min
+from django.utils import timezone
+
+from .models import OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_email(subject, body, to, html_body='', from_email=None):
+    """Store a message in the outbox; it is sent by the next worker pass."""
+    return OutboundEmail.objects.create(
+        subject=subject,
+        body=body,
+        html_body=html_body,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        to=list(to),
+    )
+
+
+def retry_delay(attempts, base=60, cap=3600):
+    """Seconds to wait before retry number ``attempts`` (1-based), doubling each time."""
+    return min(cap, base * 2 ** (attempts - 1))
+
+
+def claim_batch(batch_size, lease=300):
+    """Return up to ``batch_size`` due messages, hidden from other workers for ``lease`` seconds.
+
+    The lease pushes ``next_attempt_at`` forward, so a worker that dies
+    mid-batch only delays those messages. On databases with SKIP LOCKED
+    several workers can claim concurrently; on SQLite run a single worker.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(
+            OutboundEmail.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        if batch:
+            OutboundEmail.objects.filter(pk__in=[email.pk for email in batch]).update(
+                next_attempt_at=now + timedelta(seconds=lease)
+            )
+    return batch
+
+
+def send_batch(batch, connection=None, max_attempts=5, backoff=60):
+    """Send ``batch`` over one SMTP connection and record the outcome of each message.
+
+    Failed messages are rescheduled with exponential backoff until they have
+    been tried ``max_attempts`` times, then marked failed. Returns a dict of
+    counts plus the wall time the batch took.
+    """
+    started = time.monotonic()
+    connection = connection or get_connection()
+    sent, errors = [], {}
+    try:
+        connection.open()
+    except Exception as e:
+        # No connection means nothing in the batch could go out
+        errors = {email.pk: str(e) for email in batch}
+    else:
+        try:
+            for email in batch:
+                message = EmailMultiAlternatives(
+                    subject=email.subject,
+                    body=email.body,
+                    from_email=email.from_email,
+                    to=email.to,
+                    connection=connection,
+                )
+                if email.html_body:
+                    message.attach_alternative(email.html_body, 'text/html')
+                try:
+                    message.send()
+                except Exception as e:
+                    errors[email.pk] = str(e)
+                else:
+                    sent.append(email.pk)
+        finally:
+            connection.close()
+
+    now = timezone.now()
+    if sent:
+        OutboundEmail.objects.filter(pk__in=sent).update(
+            status='sent', sent_at=now, attempts=F('attempts') + 1, last_error=''
+        )
+    retried = failed = 0
+    for email in batch:
+        if email.pk not in errors:
+            continue
+        attempts = email.attempts + 1
+        if attempts >= max_attempts:
+            status, next_attempt_at = 'failed', now
+            failed += 1
+        else:
+            status, next_attempt_at = 'pending', now + timedelta(seconds=retry_delay(attempts, backoff))
+            retried += 1
+        OutboundEmail.objects.filter(pk=email.pk).update(
+            status=status, attempts=attempts, next_attempt_at=next_attempt_at, last_error=errors[email.pk]
+        )
+        logger.warning('Email %s attempt %s failed: %s', email.pk, attempts, errors[email.pk])
+
+    return {
+        'sent': len(sent),
+        'retried': retried,
+        'failed': failed,
+        'seconds': time.monotonic() - started,
+    }
+
+
+def send_due(batch_size=None, connection=None):
+    """Claim one batch of due messages and send it, using the MAIL_QUEUE settings."""
+    config = settings.MAIL_QUEUE
+    batch = claim_batch(batch_size or config['BATCH_SIZE'], lease=config['LEASE'])
+    if not batch:
+        return {'sent': 0, 'retried': 0, 'failed': 0, 'seconds': 0.0}
+    return send_batch(
+        batch,
+        connection=connection,
+        max_attempts=config['MAX_ATTEMPTS'],
+        backoff=config['RETRY_BACKOFF'],
+    )
+
+
+def queue_stats(sample=100):
+    """Outbox health for monitoring.
+
+    ``pending`` is the queue depth and ``oldest_pending_seconds`` how long
+    its oldest message has waited; ``send_latency_seconds`` is the mean
+    time from enqueue to delivery over the last ``sample`` sent messages.
+    """
+    now = timezone.now()
+    pending = OutboundEmail.objects.filter(status='pending')
+    oldest = pending.aggregate(oldest=Min('created_at'))['oldest']
+    recent = OutboundEmail.objects.filter(status='sent').order_by('-sent_at').values_list('created_at', 'sent_at')[:sample]
+    latencies = [(sent_at - created_at).total_seconds() for created_at, sent_at in recent]
+    return {
+        'pending': pending.count(),
+        'failed': OutboundEmail.objects.filter(status='failed').count(),
+        'oldest_pending_seconds': (now - oldest).total_seconds() if oldest else 0.0,
+        'send_latency_seconds': sum(latencies) / len(latencies) if latencies else 0.0,
+    }
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from patients.ingestion import backfill_spectrum_summaries
+
+
+class Command(BaseCommand):
+    help = 'Compute the stored summary (range, intensity statistics, peak, area) of spectra that lack one'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Recompute every spectrum, not only those without a summary')
+        parser.add_argument('--batch-size', type=int, default=200, help='Spectra loaded and saved per batch')
+
+    def handle(self, *args, **options):
+        updated = backfill_spectrum_summaries(recompute=options['all'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Computed summaries for {updated} spectra'))
@@ -0,0 +1,262 @@
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from patients.benchmark import (
+    LatencyTracker, LoadGenerator, QueryCounter, RecordingChannelLayer, WebLoad,
+    database_size, peak_rss_mb, percentile,
+)
+from patients.broker import LocalBroker
+from patients.ingestion import device_cache, session_cache
+from patients.management.commands.run_mqtt import Command as RunMqttCommand
+from patients.models import Device, MeasurementSession, Patient, Spectrum
+
+DEVICE_PREFIX = 'BENCH-'
+
+
+class BenchConsumer(RunMqttCommand):
+    """run_mqtt that reports when it has subscribed"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.subscribed = threading.Event()
+
+    def on_connect(self, client, userdata, flags, rc):
+        super().on_connect(client, userdata, flags, rc)
+        self.subscribed.set()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark MQTT ingestion against a synthetic device fleet and record the results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=10, help='Simulated devices, each with its own MQTT client')
+        parser.add_argument('--sessions', type=int, default=100, help='Measurement sessions, spread across the devices')
+        parser.add_argument('--points', type=int, default=1000, help='Points per session')
+        parser.add_argument('--chunk', type=int, default=1000,
+                            help='Points per message; 1 sends single-point payloads')
+        parser.add_argument('--rate', type=float, default=0, help='Messages per second per device (0 = unlimited)')
+        parser.add_argument('--mode', choices=['thread', 'asyncio'], default='thread', help='run_mqtt ingestion mode')
+        parser.add_argument('--batch-size', type=int, default=settings.MQTT.get('BATCH_SIZE', 500))
+        parser.add_argument('--flush-interval', type=float, default=settings.MQTT.get('FLUSH_INTERVAL', 1.0))
+        parser.add_argument('--broker', help='host:port of a running broker such as mosquitto '
+                                             '(default: an in-process broker)')
+        parser.add_argument('--web-threads', type=int, default=0,
+                            help='Threads issuing web-like reads and occasional writes during the run')
+        parser.add_argument('--timeout', type=float, default=120, help='Give up waiting for frames after this many seconds')
+        parser.add_argument('--label', default='', help='Free-form label stored with the results')
+        parser.add_argument('--output', default=str(settings.BASE_DIR / 'benchmarks' / 'ingestion.jsonl'),
+                            help='JSON Lines file the results are appended to')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Keep the benchmark database, with its devices, sessions and spectra, for inspection')
+
+    def handle(self, *args, **options):
+        if options['devices'] < 1 or options['sessions'] < 1 or options['points'] < 1 or options['chunk'] < 1:
+            raise CommandError('--devices, --sessions, --points and --chunk must be positive')
+
+        broker = None
+        if options['broker']:
+            host, _, port = options['broker'].rpartition(':')
+            host, port = host or 'localhost', int(port)
+        else:
+            broker = LocalBroker(port=0).start()
+            host, port = broker.host, broker.port
+
+        # Fixtures go in a throwaway database, never the one the app is using
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+            # A file that every consumer and web thread can open, so writes contend as they would live
+            test_settings['NAME'] = os.path.join(tempfile.gettempdir(), 'patients_bench_ingestion.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            sessions = self.create_fleet(options['devices'], options['sessions'])
+            result = self.run(options, host, port, sessions)
+        finally:
+            if broker:
+                broker.stop()
+            device_cache.clear()
+            session_cache.clear()
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        self.report(result)
+        self.save(result, options['output'])
+
+    def create_fleet(self, device_count, session_count):
+        self.delete_fleet()
+        patient = Patient.objects.create(name=f'{DEVICE_PREFIX}patient')
+        devices = Device.objects.bulk_create([
+            Device(device_id=f'{DEVICE_PREFIX}{index:04d}', name=f'Benchmark device {index}')
+            for index in range(device_count)
+        ])
+        sessions = MeasurementSession.objects.bulk_create([
+            MeasurementSession(patient=patient, device=devices[index % device_count])
+            for index in range(session_count)
+        ])
+        return [(session.device.device_id, str(session.session_id)) for session in sessions]
+
+    def delete_fleet(self):
+        MeasurementSession.objects.filter(device__device_id__startswith=DEVICE_PREFIX).delete()
+        Device.objects.filter(device_id__startswith=DEVICE_PREFIX).delete()
+        Patient.objects.filter(name=f'{DEVICE_PREFIX}patient').delete()
+        device_cache.clear()
+        session_cache.clear()
+
+    def run(self, options, host, port, sessions):
+        tracker = LatencyTracker()
+        RecordingChannelLayer.tracker = tracker
+        # Keep run_mqtt's metrics and summaries but not its output
+        devnull = open(os.devnull, 'w')
+        consumer = BenchConsumer(stdout=devnull, stderr=devnull)
+        overrides = override_settings(
+            MQTT={**settings.MQTT, 'BROKER': host, 'PORT': port},
+            CHANNEL_LAYERS={'default': {'BACKEND': 'patients.benchmark.RecordingChannelLayer'}},
+        )
+        size_before = database_size()
+        with overrides, QueryCounter(ignore_threads=WebLoad.thread_name) as queries:
+            thread = threading.Thread(target=call_command, args=(consumer,), kwargs={
+                'batch_size': options['batch_size'],
+                'flush_interval': options['flush_interval'],
+                'asyncio': options['mode'] == 'asyncio',
+            }, daemon=True)
+            thread.start()
+            if not consumer.subscribed.wait(10):
+                raise CommandError(f'run_mqtt did not connect to the broker at {host}:{port}')
+            # Let the SUBSCRIBE reach the broker before publishing
+            time.sleep(0.2)
+
+            generator = LoadGenerator(
+                host, port, sessions,
+                points=options['points'], chunk=options['chunk'], rate=options['rate'], tracker=tracker,
+            )
+            web = WebLoad(
+                [session_id for _, session_id in sessions], threads=options['web_threads']
+            ).start()
+            started = time.perf_counter()
+            generator.run()
+            published = time.perf_counter()
+
+            # Wait for every point to come back as a frame, or for frames to stop arriving
+            deadline = published + options['timeout']
+            while tracker.outstanding and time.perf_counter() < deadline:
+                idle_since = tracker.last_frame or published
+                if time.perf_counter() - max(idle_since, published) > max(5.0, options['flush_interval'] * 5):
+                    break
+                time.sleep(0.05)
+            finished = tracker.last_frame or published
+            web.stop()
+
+            consumer.stopping.set()
+            thread.join(timeout=30)
+        RecordingChannelLayer.tracker = None
+        devnull.close()
+        size_after = database_size()
+
+        session_ids = [session_id for _, session_id in sessions]
+        points_stored = sum(Spectrum.objects.filter(session__session_id__in=session_ids)
+                            .values_list('point_count', flat=True))
+        elapsed = max(finished - started, 1e-9)
+        latencies = tracker.latencies
+        rss = peak_rss_mb()
+        return {
+            'timestamp': datetime.now(dt_timezone.utc).isoformat(),
+            'version': self.git_version(),
+            'label': options['label'],
+            'params': {
+                'devices': options['devices'],
+                'sessions': options['sessions'],
+                'points': options['points'],
+                'chunk': options['chunk'],
+                'rate': options['rate'],
+                'mode': options['mode'],
+                'batch_size': options['batch_size'],
+                'flush_interval': options['flush_interval'],
+                'broker': options['broker'] or 'in-process',
+                'database': settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1],
+                'database_profile': settings.DATABASE_PROFILE,
+                'web_threads': options['web_threads'],
+            },
+            'messages': generator.messages,
+            'points_sent': options['sessions'] * options['points'],
+            'points_stored': points_stored,
+            'messages_without_frame': tracker.outstanding,
+            'seconds': round(elapsed, 3),
+            'publish_seconds': round(published - started, 3),
+            'points_per_second': round(points_stored / elapsed, 1),
+            'messages_per_second': round(generator.messages / elapsed, 1),
+            'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+            'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            'frames': tracker.frames,
+            'queries': dict(queries.counts),
+            'write_statements_per_message': round(queries.writes / max(generator.messages, 1), 3),
+            'payload_bytes': generator.payload_bytes,
+            'db_bytes_written': size_after - size_before if size_before is not None else None,
+            'db_bytes_per_payload_byte': (
+                round((size_after - size_before) / max(generator.payload_bytes, 1), 3)
+                if size_before is not None else None
+            ),
+            'peak_rss_mb': round(rss, 1) if rss is not None else None,
+            'web_requests': len(web.latencies),
+            'web_writes': web.writes,
+            'web_p50_ms': round(percentile(web.latencies, 0.5) * 1000, 2) if web.latencies else None,
+            'web_p99_ms': round(percentile(web.latencies, 0.99) * 1000, 2) if web.latencies else None,
+            'lock_errors': web.lock_errors,
+        }
+
+    def git_version(self):
+        try:
+            return subprocess.run(
+                ['git', 'describe', '--always', '--dirty'],
+                cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=5,
+            ).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    def report(self, result):
+        self.stdout.write(self.style.SUCCESS(
+            f"{result['points_stored']}/{result['points_sent']} points in {result['seconds']}s: "
+            f"{result['points_per_second']} points/s, {result['messages_per_second']} messages/s"
+        ))
+        self.stdout.write(f"Publish-to-frame latency: p50 {result['latency_p50_ms']} ms, p99 {result['latency_p99_ms']} ms")
+        self.stdout.write(
+            f"Writes: {result['write_statements_per_message']} statements/message, "
+            f"{result['db_bytes_per_payload_byte']} DB bytes per payload byte; queries {result['queries']}"
+        )
+        self.stdout.write(f"Peak RSS: {result['peak_rss_mb']} MB")
+        if result['params']['web_threads']:
+            self.stdout.write(
+                f"Web load: {result['web_requests']} request(s), {result['web_writes']} write(s), "
+                f"p50 {result['web_p50_ms']} ms, p99 {result['web_p99_ms']} ms, "
+                f"{result['lock_errors']} 'database is locked' error(s)"
+            )
+        if result['messages_without_frame']:
+            self.stdout.write(self.style.WARNING(
+                f"{result['messages_without_frame']} message(s) never appeared in a frame "
+                f"(rejected, or still pending when the run timed out)"
+            ))
+
+    def save(self, result, path):
+        previous = None
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    entry = json.loads(line)
+                    if entry.get('params') == result['params']:
+                        previous = entry
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as file:
+            file.write(json.dumps(result) + '\n')
+        self.stdout.write(f'Results appended to {path}')
+        if previous:
+            self.stdout.write(
+                f"Previous run with the same parameters ({previous.get('version')}, {previous['timestamp']}): "
+                f"{previous['points_per_second']} points/s, p99 {previous['latency_p99_ms']} ms"
+            )
@@ -0,0 +1,214 @@
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from patients.models import Device, MeasurementSession, Patient, Spectrum, reserve_patient_ids
+
+# Per view: (maximum queries, median latency budget in ms) at the default volumes.
+# Query budgets are independent of data volume; raise one only with a reason.
+VIEW_BUDGETS = {
+    'dashboard': (6, 150),
+    'patient_list': (5, 150),
+    'patient_detail': (7, 150),
+    'session_detail': (6, 400),
+    'session_data': (5, 100),
+    'export_csv': (5, 500),
+    'export_xlsx': (5, 3000),
+}
+
+
+class Command(BaseCommand):
+    help = 'Seed a benchmark database and check query-count and latency budgets for the main views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=100_000)
+        parser.add_argument('--sessions', type=int, default=1_000_000)
+        parser.add_argument('--spectra', type=int, default=50,
+                            help='Sessions that get spectral data (the rest stay empty)')
+        parser.add_argument('--min-points', type=int, default=2_000)
+        parser.add_argument('--max-points', type=int, default=20_000)
+        parser.add_argument('--repeat', type=int, default=5, help='Timed requests per view after the first')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Keep the benchmark database and reuse it when it already holds enough data')
+        parser.add_argument('--output', default=str(settings.BASE_DIR / 'benchmarks' / 'views.jsonl'),
+                            help='JSON Lines file the results are appended to')
+        parser.add_argument('--no-fail', action='store_true', help='Report budget overruns without failing')
+
+    def handle(self, *args, **options):
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+            # A file rather than the in-memory default, so timings include real I/O
+            test_settings['NAME'] = os.path.join(tempfile.gettempdir(), 'patients_bench_views.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            self.seed(options)
+            results = self.measure(options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        failures = self.report(results)
+        self.save(options, results)
+        if failures and not options['no_fail']:
+            raise CommandError(f'{len(failures)} view(s) over budget: {", ".join(failures)}')
+
+    def seed(self, options):
+        if (Patient.objects.count() >= options['patients']
+                and MeasurementSession.objects.count() >= options['sessions']
+                and Spectrum.objects.count() >= options['spectra']):
+            self.stdout.write('Reusing seeded benchmark data')
+            return
+
+        rng = random.Random(options['seed'])
+        started = time.perf_counter()
+        MeasurementSession.objects.all().delete()
+        Patient.objects.all().delete()
+        Device.objects.all().delete()
+
+        devices = Device.objects.bulk_create([
+            Device(device_id=f'DEV{index:03d}', name=f'Spectrometer {index}') for index in range(20)
+        ])
+        batch_size = 5000
+        for start in range(0, options['patients'], batch_size):
+            count = min(batch_size, options['patients'] - start)
+            Patient.objects.bulk_create([
+                Patient(
+                    patient_id=patient_id,
+                    name=f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+                    date_of_birth=date(1940, 1, 1) + timedelta(days=rng.randrange(30000)),
+                    gender=rng.choice('MFO'),
+                    email=f'patient{start + index}@example.org',
+                    clinical_notes=rng.choice(NOTES),
+                )
+                for index, patient_id in enumerate(reserve_patient_ids(count))
+            ])
+        patient_ids = list(Patient.objects.values_list('pk', flat=True))
+
+        batch_size = 10000
+        for start in range(0, options['sessions'], batch_size):
+            count = min(batch_size, options['sessions'] - start)
+            MeasurementSession.objects.bulk_create([
+                MeasurementSession(
+                    patient_id=rng.choice(patient_ids),
+                    device=rng.choice(devices),
+                    status=rng.choice(['completed', 'completed', 'in_progress']),
+                )
+                for _ in range(count)
+            ])
+
+        # The largest spectrum goes to the session the session-level views read
+        sizes = sorted(
+            (rng.randint(options['min_points'], options['max_points']) for _ in range(options['spectra'])),
+            reverse=True,
+        )
+        sessions = MeasurementSession.objects.filter(status='completed').order_by('pk')[:options['spectra']]
+        for session, size in zip(sessions, sizes):
+            spectrum = Spectrum(session=session)
+            wavelengths = np.linspace(200.0, 1100.0, size)
+            spectrum.append(wavelengths, np.abs(np.sin(wavelengths / 37.0)) * 1000 + rng.random())
+            spectrum.save()
+        self.stdout.write(f'Seeded benchmark data in {time.perf_counter() - started:.1f}s')
+
+    def cases(self):
+        spectrum = Spectrum.objects.select_related('session').order_by('-point_count').first()
+        if spectrum is None:
+            raise CommandError('The benchmark data has no spectra; use --spectra 1 or more')
+        session_id = spectrum.session.session_id
+        patient = spectrum.session.patient
+        return {
+            'dashboard': reverse('patients:dashboard'),
+            'patient_list': reverse('patients:patient_list'),
+            'patient_detail': reverse('patients:patient_detail', args=[patient.pk]),
+            'session_detail': reverse('patients:session_detail', args=[session_id]),
+            'session_data': reverse('patients:session_data', args=[session_id]) + '?width=1200',
+            'export_csv': reverse('patients:export_csv', args=[session_id]),
+            'export_xlsx': reverse('patients:export_xlsx', args=[session_id]),
+        }
+
+    def measure(self, options):
+        user = get_user_model().objects.filter(username='bench').first() or \
+            get_user_model().objects.create_superuser('bench', 'bench@example.org', None)
+        client = Client()
+        client.force_login(user)
+
+        results = {}
+        for name, url in self.cases().items():
+            cache.clear()
+            timings = []
+            for attempt in range(options['repeat'] + 1):
+                # The query log is a bounded deque; seeding alone can fill it
+                reset_queries()
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    response = client.get(url)
+                    # Streaming responses do their work while being consumed
+                    if response.streaming:
+                        b''.join(response.streaming_content)
+                    timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 200:
+                    raise CommandError(f'{name} returned HTTP {response.status_code}')
+                if attempt == 0:
+                    query_count = len(queries)
+            max_queries, max_ms = VIEW_BUDGETS[name]
+            median = statistics.median(timings[1:] or timings)
+            results[name] = {
+                'url': url,
+                'queries': query_count,
+                'max_queries': max_queries,
+                'first_ms': round(timings[0], 1),
+                'median_ms': round(median, 1),
+                'max_ms': max_ms,
+            }
+        return results
+
+    def report(self, results):
+        failures = []
+        self.stdout.write(f'{"view":<16}{"queries":>12}{"first ms":>12}{"median ms":>18}')
+        for name, result in results.items():
+            over = []
+            if result['queries'] > result['max_queries']:
+                over.append('queries')
+            if result['median_ms'] > result['max_ms']:
+                over.append('latency')
+            line = (
+                f'{name:<16}{result["queries"]:>6} / {result["max_queries"]:<3}'
+                f'{result["first_ms"]:>12}{result["median_ms"]:>10} / {result["max_ms"]:<6}'
+            )
+            if over:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR(f'{line} over budget: {", ".join(over)}'))
+            else:
+                self.stdout.write(self.style.SUCCESS(line))
+        return failures
+
+    def save(self, options, results):
+        path = options['output']
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as file:
+            file.write(json.dumps({
+                'timestamp': datetime.now(dt_timezone.utc).isoformat(),
+                'params': {key: options[key] for key in ('patients', 'sessions', 'spectra', 'min_points', 'max_points')},
+                'database': connection.vendor,
+                'views': results,
+            }) + '\n')
+        self.stdout.write(f'Results appended to {path}')
+
+
+FIRST_NAMES = ['Amelia', 'Ben', 'Chloe', 'Daniel', 'Esha', 'Farid', 'Grace', 'Hiro', 'Isla', 'Jonas',
+               'Kavya', 'Liam', 'Maya', 'Noah', 'Olga', 'Priya', 'Quentin', 'Rosa', 'Sami', 'Tara']
+LAST_NAMES = ['Anand', 'Brown', 'Costa', 'Dubois', 'Evans', 'Fischer', 'Garcia', 'Hughes', 'Iyer', 'Jensen',
+              'Kumar', 'Lopez', 'Martin', 'Nguyen', 'Okafor', 'Patel', 'Rossi', 'Singh', 'Tanaka', 'Weber']
+NOTES = ['', 'Routine screening', 'Follow-up visit', 'Referred by GP', 'Repeat measurement requested']
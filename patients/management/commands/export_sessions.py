@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from patients.exports import EXPORT_FORMATS, filter_sessions, iter_spectra
+
+
+def date_arg(value):
+    parsed = parse_date(value)
+    if parsed is None:
+        raise ValueError(value)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = 'Export the spectra of many sessions to a ZIP of CSV files or a single Parquet file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='File to write the archive to')
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default='zip')
+        parser.add_argument('--patient', help='Patient ID, e.g. PID000001')
+        parser.add_argument('--device', help='Device ID')
+        parser.add_argument('--start', type=date_arg, help='Earliest session date (YYYY-MM-DD)')
+        parser.add_argument('--end', type=date_arg, help='Latest session date (YYYY-MM-DD)')
+        parser.add_argument('--status', help='Session status, e.g. completed')
+
+    def handle(self, *args, **options):
+        sessions = filter_sessions(
+            patient=options['patient'],
+            device=options['device'],
+            start=options['start'],
+            end=options['end'],
+            status=options['status'],
+        )
+        writer = EXPORT_FORMATS[options['format']][0]
+        try:
+            chunks = writer(iter_spectra(sessions))
+        except ImportError as e:
+            raise CommandError(f'{options["format"]} export needs an optional dependency: {e}')
+
+        # Chunks are written as they are produced so memory stays bounded
+        written = 0
+        with open(options['output'], 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk)
+                written += len(chunk)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} bytes to {options["output"]}'))
@@ -0,0 +1,34 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from patients.importing import READERS, PatientImporter
+
+
+class Command(BaseCommand):
+    help = 'Import patients from a CSV or XLSX file, validating each row like the patient form'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or XLSX file with a header row of patient fields')
+        parser.add_argument('--format', choices=sorted(READERS), help='File format (default: from the extension)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows written per transaction')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if file_format not in READERS:
+            raise CommandError(f'Unsupported file format: {file_format or "unknown"}')
+
+        importer = PatientImporter(batch_size=options['batch_size'], on_batch=self.report_progress)
+        try:
+            with open(options['path'], 'rb') as file:
+                importer.run(READERS[file_format](file))
+        except OSError as e:
+            raise CommandError(f'Could not read {options["path"]}: {e}')
+
+        for row_number, message in importer.errors:
+            self.stderr.write(f'Row {row_number}: {message}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {importer.imported} patient(s); {len(importer.errors)} row(s) rejected'
+        ))
+
+    def report_progress(self, importer):
+        self.stdout.write(f'Imported {importer.imported} patient(s) so far, {len(importer.errors)} rejected')
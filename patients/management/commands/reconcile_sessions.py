@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from patients.ingestion import reconcile_session_status
+
+
+class Command(BaseCommand):
+    help = 'Mark in-progress sessions whose spectral data has stopped arriving as completed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--idle-timeout',
+            type=float,
+            default=settings.MQTT.get('SESSION_IDLE_TIMEOUT', 30.0),
+            help='Only complete sessions that have received no new points for this many seconds'
+        )
+
+    def handle(self, *args, **options):
+        updated = reconcile_session_status(options['idle_timeout'])
+        self.stdout.write(self.style.SUCCESS(f'Marked {updated} session(s) as completed'))
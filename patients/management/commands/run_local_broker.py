@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from patients.broker import LocalBroker
+
+
+class Command(BaseCommand):
+    help = 'Run a minimal in-process MQTT broker for local development and tests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on')
+        parser.add_argument('--port', type=int, default=1883, help='Port to listen on')
+
+    def handle(self, *args, **options):
+        broker = LocalBroker(options['host'], options['port'])
+        self.stdout.write(self.style.SUCCESS(f'Local MQTT broker listening on {options["host"]}:{options["port"]}'))
+        try:
+            broker.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping local broker')
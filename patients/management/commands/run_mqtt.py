@@ -1,17 +1,180 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 import paho.mqtt.client as mqtt
+import asyncio
 import json
+import logging
+import random
+import signal
+import subprocess
+import sys
+import threading
+import time
 from django.conf import settings
 from django.utils import timezone
-from patients.models import Device, MeasurementSession, SpectralPoint
+from patients import metrics
+from patients.models import Device, MeasurementSession
+from patients.async_ingestion import AsyncIngestion
+from patients.ingestion import (
+    FrameCoalescer, IdleSessionSweeper, SpectralBuffer, complete_sessions, device_cache, device_timestamp,
+    session_cache,
+)
+from patients.spectra import decode_spectrum
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 
+logger = logging.getLogger(__name__)
+
+# Warnings for rejected messages are repeated at most this often per reason
+REJECT_LOG_INTERVAL = 10.0
+
+
+def total(counter):
+    return sum(counter.values().values())
+
+
 class Command(BaseCommand):
     help = 'Run MQTT subscriber to ingest device data (blocking)'
+    # Shared-subscription group this process joins, if any
+    share_group = None
+    log_sample = 1.0
+    stats_interval = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # reason -> (monotonic time of the last warning, rejections not logged since)
+        self.reject_log = {}
+        self.reject_lock = threading.Lock()
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.MQTT.get('BATCH_SIZE', 500),
+            help='Flush buffered points once this many are pending'
+        )
+        parser.add_argument(
+            '--flush-interval',
+            type=float,
+            default=settings.MQTT.get('FLUSH_INTERVAL', 1.0),
+            help='Flush buffered points after they have waited this many seconds'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Run this many consumer processes, with the broker splitting messages between them'
+        )
+        parser.add_argument(
+            '--share-group',
+            help='Subscribe through the $share/<group>/ shared subscription so the broker '
+                 'splits messages between consumers in the group (set by --workers)'
+        )
+        parser.add_argument(
+            '--asyncio',
+            action='store_true',
+            help='Run the MQTT client on an asyncio event loop and write to the database from a thread pool'
+        )
+        parser.add_argument(
+            '--db-threads',
+            type=int,
+            default=settings.MQTT.get('DB_THREADS', 2),
+            help='With --asyncio: database threads, each handling its own share of the devices'
+        )
+        parser.add_argument(
+            '--queue-size',
+            type=int,
+            default=settings.MQTT.get('QUEUE_SIZE', 10000),
+            help='With --asyncio: messages each database thread may have waiting before new ones are dropped'
+        )
+        parser.add_argument(
+            '--idle-timeout',
+            type=float,
+            default=settings.MQTT.get('SESSION_IDLE_TIMEOUT', 30.0),
+            help='Mark a session completed once it has received no new points for this many seconds'
+        )
+        parser.add_argument(
+            '--drain-timeout',
+            type=float,
+            default=30.0,
+            help='Seconds to wait for workers to flush their buffers on shutdown'
+        )
+        parser.add_argument(
+            '--metrics-port',
+            type=int,
+            default=settings.MQTT.get('METRICS_PORT', 0),
+            help='Serve Prometheus metrics on this port (0 = off); with --workers, worker I uses port + I'
+        )
+        parser.add_argument(
+            '--metrics-host',
+            default=settings.MQTT.get('METRICS_HOST', '127.0.0.1'),
+            help='Interface for --metrics-port'
+        )
+        parser.add_argument(
+            '--stats-interval',
+            type=float,
+            default=settings.MQTT.get('STATS_INTERVAL', 60.0),
+            help='Log a summary line of throughput, rejects and latencies this often in seconds (0 = off)'
+        )
+        parser.add_argument(
+            '--log-sample',
+            type=float,
+            default=settings.MQTT.get('LOG_SAMPLE_RATE', 1.0),
+            help='Share of messages logged in detail at --verbosity 2'
+        )
 
     def handle(self, *args, **options):
-        self.stdout.write(self.style.SUCCESS('Starting MQTT consumer...'))
+        if options['workers'] > 1:
+            return self.supervise(options)
+
+        self.share_group = options['share_group']
+        self.stopping = threading.Event()
+        self.handle_stop_signals()
+        self.stdout.write(self.style.SUCCESS(
+            'Starting MQTT consumer...' if self.share_group is None
+            else f'Starting MQTT consumer in share group {self.share_group}...'
+        ))
+
+        # Points are buffered and written in batches by size or age
+        self.buffer = SpectralBuffer(
+            max_points=options['batch_size'],
+            max_delay=options['flush_interval'],
+            on_flush=self.on_flush
+        )
+        metrics.mqtt_buffered_points.set_function(lambda: len(self.buffer))
+        # Sessions end on an explicit "complete" message or after going idle
+        self.sweeper = IdleSessionSweeper(options['idle_timeout'])
+        self._sweep = None
+        metrics_server = None
+        if options['metrics_port']:
+            try:
+                metrics_server = metrics.serve_metrics(options['metrics_host'], options['metrics_port'])
+            except OSError as e:
+                raise CommandError(f'Cannot serve metrics on port {options["metrics_port"]}: {str(e)}')
+            self.stdout.write(f'Serving metrics at http://{options["metrics_host"]}:{options["metrics_port"]}/metrics')
+
+        self.start_logging(options)
+        # Catch sessions a previous run left in progress
+        self.sweep_idle_sessions(everything=True)
+        try:
+            if options['asyncio']:
+                self.run_asyncio(options)
+            else:
+                self.run_threaded(options)
+        finally:
+            if self.stats_interval:
+                self.log_summary()
+            self.stop_logging()
+            if metrics_server:
+                metrics_server.shutdown()
+
+    def run_threaded(self, options):
+        """Ingest with paho's network thread and flush from this one."""
+        # New points are pushed to viewers in coalesced frames
+        self.frames = FrameCoalescer(
+            self.send_frame,
+            interval=settings.MQTT.get('FRAME_INTERVAL', 0.25),
+            max_points=settings.MQTT.get('FRAME_MAX_POINTS', 5000)
+        )
         
         # Initialize MQTT client
         client = mqtt.Client()
@@ -30,26 +193,231 @@ class Command(BaseCommand):
             self.stderr.write(self.style.ERROR(f'Failed to connect to MQTT broker: {str(e)}'))
             return
 
-        # Start the MQTT loop
-        client.loop_forever()
+        # Run the network loop in a background thread and flush on age here
+        client.loop_start()
+        try:
+            while not self.stopping.wait(min(0.1, options['flush_interval'])):
+                if self.buffer.is_due():
+                    self.flush_buffer()
+                self.frames.release()
+                if self.sweeper.is_due():
+                    self.sweep_idle_sessions()
+                self.maybe_log_summary()
+            self.stdout.write('Stopping MQTT consumer...')
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping MQTT consumer...')
+        finally:
+            client.disconnect()
+            client.loop_stop()
+            self.flush_buffer()
+            self.frames.release(force=True)
+
+    def run_asyncio(self, options):
+        """Ingest with the network client on an event loop; see AsyncIngestion."""
+        client = mqtt.Client()
+        client.on_connect = self.on_connect
+        engine = AsyncIngestion(
+            client,
+            self.process_spectral_data,
+            self.buffer,
+            channel_layer=get_channel_layer(),
+            lanes=options['db_threads'],
+            queue_size=options['queue_size'],
+            max_wait=options['flush_interval'],
+            frame_interval=settings.MQTT.get('FRAME_INTERVAL', 0.25),
+            frame_max_points=settings.MQTT.get('FRAME_MAX_POINTS', 5000),
+            on_error=self.stderr.write,
+        )
+        # on_flush pushes into the engine's frames, which it sends with native awaits
+        self.frames = engine.frames
+
+        def on_tick():
+            # Sweeps query the database, so they run on one of the engine's threads
+            if self.sweeper.is_due() and (self._sweep is None or self._sweep.done()):
+                self._sweep = engine.executor.submit(self.sweep_idle_sessions)
+            self.maybe_log_summary()
+        try:
+            asyncio.run(engine.run(
+                settings.MQTT['BROKER'],
+                settings.MQTT['PORT'],
+                settings.MQTT.get('KEEPALIVE', 60),
+                self.stopping,
+                tick=min(0.1, options['flush_interval']),
+                on_tick=on_tick,
+            ))
+        except OSError as e:
+            self.stderr.write(self.style.ERROR(f'Failed to connect to MQTT broker: {str(e)}'))
+            return
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(
+            f'Stopped MQTT consumer: {engine.received} message(s) received, '
+            f'{engine.dropped} dropped, {engine.delayed} delayed'
+        )
+
+    def start_logging(self, options):
+        """Log to this command's stdout at a level set by ``--verbosity``.
+
+        Level 2 and above adds per-message detail for a ``--log-sample``
+        share of messages. Records go to the project's LOGGING handlers
+        instead when the logger already has any.
+        """
+        verbosity = options['verbosity']
+        self.log_sample = options['log_sample']
+        self.stats_interval = options['stats_interval']
+        self.log_handler = None
+        logger.setLevel(logging.DEBUG if verbosity >= 2 else logging.INFO if verbosity == 1 else logging.WARNING)
+        if not logger.handlers:
+            self.log_handler = logging.StreamHandler(self.stdout)
+            self.log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+            logger.addHandler(self.log_handler)
+            logger.propagate = False
+        self.stats_last = self.snapshot()
+        self.next_summary = time.monotonic() + self.stats_interval
+
+    def stop_logging(self):
+        if self.log_handler:
+            logger.removeHandler(self.log_handler)
+            logger.propagate = True
+
+    def snapshot(self):
+        return {
+            'time': time.monotonic(),
+            'messages': total(metrics.mqtt_messages),
+            'persisted': total(metrics.mqtt_points_persisted),
+            'duplicates': total(metrics.mqtt_points_duplicate),
+            'rejected': {key[0]: value for key, value in metrics.mqtt_rejected.values().items()},
+            'db_write': metrics.mqtt_db_write.totals(),
+            'channel_send': metrics.mqtt_channel_send.totals(),
+            'lag': metrics.mqtt_lag.totals(),
+        }
+
+    def maybe_log_summary(self):
+        if self.stats_interval and time.monotonic() >= self.next_summary:
+            self.log_summary()
+            self.next_summary = time.monotonic() + self.stats_interval
+
+    def log_summary(self):
+        """Log throughput, rejects and average latencies since the previous summary."""
+        current, last = self.snapshot(), self.stats_last
+        self.stats_last = current
+
+        def average(name, scale):
+            count = current[name][0] - last[name][0]
+            return (current[name][1] - last[name][1]) / count * scale if count else 0.0
+
+        elapsed = max(current['time'] - last['time'], 1e-9)
+        rejected = ' '.join(
+            f'{reason}={count - last["rejected"].get(reason, 0)}'
+            for reason, count in sorted(current['rejected'].items())
+            if count > last['rejected'].get(reason, 0)
+        ) or 'none'
+        logger.info(
+            '%.1f msg/s, %d point(s) persisted, %d duplicate(s), rejected: %s, '
+            'DB write avg %.1f ms over %d batch(es), channel send avg %.1f ms, device lag avg %.2fs, %d buffered',
+            (current['messages'] - last['messages']) / elapsed,
+            current['persisted'] - last['persisted'],
+            current['duplicates'] - last['duplicates'],
+            rejected,
+            average('db_write', 1000),
+            current['db_write'][0] - last['db_write'][0],
+            average('channel_send', 1000),
+            average('lag', 1),
+            len(self.buffer),
+        )
+
+    def reject(self, reason, message):
+        """Count a message that was not ingested and warn, at most once per interval per reason."""
+        metrics.mqtt_rejected.inc(reason=reason)
+        now = time.monotonic()
+        with self.reject_lock:
+            logged, suppressed = self.reject_log.get(reason, (None, 0))
+            if logged is not None and now - logged < REJECT_LOG_INTERVAL:
+                self.reject_log[reason] = (logged, suppressed + 1)
+                return
+            self.reject_log[reason] = (now, 0)
+        if suppressed:
+            message += f' ({suppressed} more {reason} rejection(s) since the last warning)'
+        logger.warning(message)
+
+    def handle_stop_signals(self):
+        """Turn SIGTERM/SIGINT into a clean stop that drains the buffer."""
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *args: self.stopping.set())
+
+    def supervise(self, options):
+        """Run ``--workers`` consumer processes and restart any that exit.
+
+        The workers join one shared subscription, so the broker delivers
+        each message to only one of them. Messages for a session may then be
+        handled by different workers, which is safe because writes merge
+        into the spectrum by wavelength under a row lock. On SIGTERM/SIGINT
+        the workers are asked to stop, flush and exit, and are killed after
+        ``--drain-timeout``.
+        """
+        count = options['workers']
+        self.stopping = threading.Event()
+        self.handle_stop_signals()
+
+        def start(index):
+            return subprocess.Popen([
+                sys.executable, str(settings.BASE_DIR / 'manage.py'), 'run_mqtt',
+                '--share-group', settings.MQTT.get('SHARE_GROUP', 'ingest'),
+                '--batch-size', str(options['batch_size']),
+                '--flush-interval', str(options['flush_interval']),
+                '--idle-timeout', str(options['idle_timeout']),
+                '--stats-interval', str(options['stats_interval']),
+                '--log-sample', str(options['log_sample']),
+                '--verbosity', str(options['verbosity']),
+                *(['--metrics-host', options['metrics_host'],
+                   '--metrics-port', str(options['metrics_port'] + index)] if options['metrics_port'] else []),
+                *(['--asyncio', '--db-threads', str(options['db_threads']),
+                   '--queue-size', str(options['queue_size'])] if options['asyncio'] else []),
+            ])
+
+        self.stdout.write(self.style.SUCCESS(f'Starting {count} MQTT consumer workers...'))
+        workers = [start(index) for index in range(count)]
+        started = [time.monotonic()] * count
+        try:
+            while not self.stopping.wait(1.0):
+                for index, worker in enumerate(workers):
+                    # Back off so a worker that cannot start does not spin
+                    if worker.poll() is not None and time.monotonic() - started[index] >= 5:
+                        self.stderr.write(f'Worker {index} exited with code {worker.returncode}; restarting')
+                        workers[index] = start(index)
+                        started[index] = time.monotonic()
+        finally:
+            self.stdout.write('Stopping MQTT consumer workers...')
+            for worker in workers:
+                if worker.poll() is None:
+                    worker.terminate()
+            deadline = time.monotonic() + options['drain_timeout']
+            for index, worker in enumerate(workers):
+                try:
+                    worker.wait(timeout=max(0, deadline - time.monotonic()))
+                except subprocess.TimeoutExpired:
+                    self.stderr.write(f'Worker {index} did not drain in time; killing it')
+                    worker.kill()
+                    worker.wait()
 
     def on_connect(self, client, userdata, flags, rc):
         """Callback for when the client receives a CONNACK response from the server."""
         if rc == 0:
             self.stdout.write(self.style.SUCCESS('Successfully connected to MQTT broker'))
-            # Subscribe to the data topic
-            client.subscribe(settings.MQTT['DATA_TOPIC'])
-            self.stdout.write(f'Subscribed to topic: {settings.MQTT["DATA_TOPIC"]}')
+            # Subscribe to the data topic, sharing it with the rest of the group if any
+            topic = settings.MQTT['DATA_TOPIC']
+            if self.share_group:
+                topic = f'$share/{self.share_group}/{topic}'
+            client.subscribe(topic)
+            self.stdout.write(f'Subscribed to topic: {topic}')
         else:
             self.stderr.write(self.style.ERROR(f'Failed to connect to MQTT broker with result code {rc}'))
 
     def on_message(self, client, userdata, msg):
         """Callback for when a PUBLISH message is received from the server."""
         try:
-            self.stdout.write(f'\n=== New MQTT Message ===')
-            self.stdout.write(f'Topic: {msg.topic}')
-            self.stdout.write(f'Payload: {msg.payload}')
-
             # Parse topic to get device_id and session_id
             topic_parts = msg.topic.split('/')
             if len(topic_parts) >= 3 and topic_parts[2] == 'measurements':
@@ -57,69 +425,98 @@ class Command(BaseCommand):
                 session_id = topic_parts[1]
                 self.process_spectral_data(device_id, session_id, msg.payload)
         except Exception as e:
-            self.stderr.write(f'Error processing message: {str(e)}')
+            self.reject('error', f'Error processing message: {str(e)}')
 
     def process_spectral_data(self, device_id, session_id, payload):
-        """Process spectral data and save to database."""
+        """Validate spectral data and queue it for the next batch write."""
+        metrics.mqtt_messages.inc()
+        # Decide once per message, so a sampled message is logged in full
+        trace = logger.isEnabledFor(logging.DEBUG) and random.random() < self.log_sample
+        if trace:
+            logger.debug('Message from device %s for session %s: %r', device_id, session_id, payload)
         try:
             # Parse JSON payload
             data = json.loads(payload.decode())
-            self.stdout.write(f'Decoded data: {data}')
+            if trace:
+                logger.debug('Decoded data: %s', data)
 
-            # Get device and session
-            device = Device.objects.get(device_id=device_id, is_active=True)
-            session = MeasurementSession.objects.get(session_id=session_id)
+            # Get device and session, cached for CACHE_TTL seconds
+            device = device_cache.get(device_id)
+            session = session_cache.get(session_id)
 
             # Check if session is already completed
             if session.status == 'completed':
-                self.stdout.write(f'Session {session_id} is already completed')
+                self.reject('session_completed', f'Session {session_id} is already completed')
                 return
 
-            # Create spectral point
-            wavelength = float(data.get('wavelength'))
-            intensity = float(data.get('intensity'))
-            
-            # Check for duplicate data point
-            if not SpectralPoint.objects.filter(session=session, wavelength=wavelength).exists():
-                SpectralPoint.objects.create(
-                    session=session,
-                    wavelength=wavelength,
-                    intensity=intensity
-                )
-                self.stdout.write(f'Added new data point to session {session_id}')
-
-                # Update session status
-                session.status = 'completed'
-                session.save(update_fields=['status', 'updated_at'])
-                
-                # Notify WebSocket clients
-                self.notify_websocket(session_id, 'data_update')
-                self.stdout.write(f'Marked session {session_id} as completed')
-            else:
-                self.stdout.write(f'Skipping duplicate data point for session {session_id}')
+            # Optional device clock reading, used to measure end-to-end lag
+            sent_at = device_timestamp(data.get('timestamp'))
+            complete = data.get('complete') is True
+
+            # Whole-spectrum payloads are validated as arrays and written at once
+            if 'wavelengths' in data:
+                wavelengths, intensities = decode_spectrum(data)
+                self.buffer.extend(session, wavelengths, intensities, sent_at=sent_at)
+            elif 'wavelength' in data or not complete:
+                # Queue spectral point; duplicates are dropped when the batch is written
+                wavelength = float(data.get('wavelength'))
+                intensity = float(data.get('intensity'))
+                self.buffer.add(session, wavelength, intensity, sent_at=sent_at)
+
+            # End of scan: write everything pending for it, then close the session
+            if complete:
+                self.buffer.flush()
+                complete_sessions([(session.pk, session.session_id)])
+                logger.debug('Session %s completed by device %s', session_id, device_id)
 
         except json.JSONDecodeError as e:
-            self.stderr.write(f'Failed to decode JSON: {str(e)}')
+            self.reject('decode_error', f'Failed to decode JSON: {str(e)}')
+        except (TypeError, ValueError) as e:
+            self.reject('invalid', f'Invalid spectrum for session {session_id}: {str(e)}')
         except Device.DoesNotExist:
-            self.stderr.write(f'Device {device_id} not found or inactive')
+            self.reject('unknown_device', f'Device {device_id} not found or inactive')
         except MeasurementSession.DoesNotExist:
-            self.stderr.write(f'Session {session_id} not found')
+            self.reject('unknown_session', f'Session {session_id} not found')
         except Exception as e:
-            self.stderr.write(f'Error processing data: {str(e)}')
+            self.reject('error', f'Error processing data: {str(e)}')
+
+    def sweep_idle_sessions(self, everything=False):
+        """Complete idle sessions, reporting rather than raising on failure."""
+        try:
+            completed = self.sweeper.sweep(everything=everything)
+        except Exception as e:
+            logger.error('Error completing idle sessions: %s', e)
+            return
+        if completed:
+            logger.info('Marked %d idle session(s) as completed', completed)
+
+    def flush_buffer(self):
+        """Write buffered points, reporting rather than raising on failure."""
+        try:
+            self.buffer.flush()
+        except Exception as e:
+            self.stderr.write(f'Error writing buffered points: {str(e)}')
+
+    def on_flush(self, written):
+        """Queue the new points of a batch write for each touched session."""
+        self.sweeper.touch(written)
+        for session, spectrum in written.items():
+            wavelengths, intensities = spectrum.since(spectrum.revision - 1)
+            logger.debug('Added %d data point(s) to session %s', wavelengths.size, session.session_id)
+            self.frames.push(session.session_id, spectrum, wavelengths, intensities)
 
-    def notify_websocket(self, session_id, message_type):
-        """Send WebSocket notification for session updates."""
+    def send_frame(self, session_id, text):
+        """Send a pre-encoded frame of new points to the session's viewers."""
+        started = time.perf_counter()
         try:
             channel_layer = get_channel_layer()
             async_to_sync(channel_layer.group_send)(
                 f'session_{session_id}',
                 {
-                    'type': 'session_update',
-                    'message': {
-                        'type': message_type,
-                        'session_id': str(session_id)
-                    }
+                    'type': 'session_points',
+                    'text': text
                 }
             )
+            metrics.mqtt_channel_send.observe(time.perf_counter() - started)
         except Exception as e:
-            self.stderr.write(f'WebSocket notification failed: {str(e)}')
\ No newline at end of file
+            self.stderr.write(f'WebSocket frame failed: {str(e)}')
@@ -0,0 +1,46 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from patients.mail import queue_stats, send_due
+
+
+class Command(BaseCommand):
+    help = 'Send queued emails in batches over a reused SMTP connection'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the due messages once and exit')
+        parser.add_argument('--batch-size', type=int, default=settings.MAIL_QUEUE['BATCH_SIZE'],
+                            help='Messages sent per SMTP connection')
+        parser.add_argument('--interval', type=float, default=settings.MAIL_QUEUE['POLL_INTERVAL'],
+                            help='Seconds to wait when nothing is due')
+        parser.add_argument('--stats', action='store_true', help='Print queue depth and latency as JSON and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            self.stdout.write(json.dumps(queue_stats()))
+            return
+
+        try:
+            while True:
+                result = send_due(options['batch_size'])
+                if result['sent'] or result['retried'] or result['failed']:
+                    self.report(result)
+                    # Keep going while full batches come back
+                    if result['sent'] + result['retried'] + result['failed'] >= options['batch_size']:
+                        continue
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping mail worker')
+
+    def report(self, result):
+        stats = queue_stats()
+        self.stdout.write(
+            f"Sent {result['sent']}, retrying {result['retried']}, failed {result['failed']} "
+            f"in {result['seconds']:.2f}s; {stats['pending']} pending, "
+            f"oldest {stats['oldest_pending_seconds']:.1f}s, "
+            f"send latency {stats['send_latency_seconds']:.1f}s"
+        )
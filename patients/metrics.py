@@ -0,0 +1,236 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Values live in the memory of each process, so every web worker and every
+``run_mqtt`` process exposes its own series; aggregate them in Prometheus.
+"""
+import math
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value) for rendering."""
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield '', key, (), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(self.labelnames, key, extra)} {format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        """Return {label values: count} for every series."""
+        with self._lock:
+            return dict(self._values)
+
+
+class Gauge(Metric):
+    """A value that goes up and down; ``set_function`` reads it at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, function, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def samples(self):
+        yield from super().samples()
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, function in functions:
+            yield '', key, (), function()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def totals(self, **labels):
+        """Return (count, sum) of the observations for one series."""
+        with self._lock:
+            counts, total = self._values.get(self._key(labels)) or ((), 0.0)
+        return sum(counts), total
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total)) for key, (counts, total) in self._values.items()]
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', key, (('le', format_value(bound)),), cumulative
+            yield '_sum', key, (), total
+            yield '_count', key, (), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add ``metric``, or return the one already registered under its name."""
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f'Metric {metric.name} is already registered differently')
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def serve_metrics(host, port, registry=REGISTRY):
+    """Serve ``registry`` over HTTP from a daemon thread and return the server.
+
+    Meant for processes without a web front end, such as ``run_mqtt``; bind
+    it to localhost or a private interface, as there is no authentication.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def gauge(name, help, labelnames=()):
+    return REGISTRY.register(Gauge(name, help, labelnames))
+
+
+def histogram(name, help, labelnames=(), buckets=DURATION_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+
+# Web requests, recorded by patients.middleware.MetricsMiddleware
+request_duration = histogram(
+    'http_request_duration_seconds', 'Time from request to the last response byte, by URL name',
+    ('view', 'method'),
+)
+requests_total = counter('http_requests_total', 'Requests handled, by URL name and status', ('view', 'method', 'status'))
+request_queries = histogram(
+    'http_request_queries', 'SQL queries run per request', ('view',), buckets=COUNT_BUCKETS,
+)
+request_query_duration = histogram('http_request_query_seconds', 'Time spent in SQL per request', ('view',))
+response_size = histogram('http_response_size_bytes', 'Response body size', ('view',), buckets=SIZE_BUCKETS)
+slow_requests_total = counter('http_slow_requests_total', 'Requests slower than the slow-request threshold', ('view',))
+
+# Most recent sampled slow requests, with their queries, for /metrics/slow/
+slow_samples = deque(maxlen=50)
+
+# MQTT ingestion, recorded by run_mqtt and patients.ingestion
+mqtt_messages = counter('mqtt_messages_total', 'Measurement messages received for this process\'s devices')
+mqtt_rejected = counter(
+    'mqtt_messages_rejected_total',
+    'Messages not ingested, by reason (decode_error, invalid, unknown_device, unknown_session, '
+    'session_completed, queue_full, error)',
+    ('reason',),
+)
+mqtt_points_persisted = counter('mqtt_points_persisted_total', 'Points written to spectra')
+mqtt_points_duplicate = counter('mqtt_points_duplicate_total', 'Points skipped because their wavelength was already stored')
+mqtt_db_write = histogram('mqtt_db_write_seconds', 'Time to write one buffered batch')
+mqtt_channel_send = histogram('mqtt_channel_send_seconds', 'Time to hand one frame to the channel layer')
+mqtt_lag = histogram(
+    'mqtt_ingest_lag_seconds', 'Time from the device timestamp in a payload until its points were written',
+    buckets=LAG_BUCKETS,
+)
+mqtt_buffered_points = gauge('mqtt_buffered_points', 'Points waiting in the write buffer')
+mqtt_queue_depth = gauge('mqtt_queue_depth', 'Messages waiting for a database thread (asyncio mode)')
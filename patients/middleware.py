@@ -0,0 +1,129 @@
+"""Request instrumentation feeding the metrics in patients.metrics."""
+import logging
+import random
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Queries kept per request for slow-request samples
+MAX_CAPTURED_QUERIES = 200
+
+
+class QueryRecorder:
+    """``execute_wrapper`` that counts and times every SQL statement."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.duration += elapsed
+            if len(self.queries) < MAX_CAPTURED_QUERIES:
+                self.queries.append({'sql': sql, 'seconds': round(elapsed, 6)})
+
+    def wrap(self):
+        """Install on every configured database for the current thread."""
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(self))
+        return stack
+
+
+class MetricsMiddleware:
+    """Record latency, SQL count and time, and response size per URL name.
+
+    Streaming responses are measured until their last chunk is sent, so
+    queries run while streaming an export are counted too, including async
+    streams whose chunks are produced in the sync thread. Requests slower
+    than ``METRICS['SLOW_REQUEST_SECONDS']`` are counted, and a
+    ``SLOW_SAMPLE_RATE`` share of them is logged with its queries and kept
+    for ``/metrics/slow/``.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with recorder.wrap():
+            response = self.get_response(request)
+        if response.streaming and response.is_async:
+            response.streaming_content = self.astream(response.streaming_content, request, response, recorder, started)
+        elif response.streaming:
+            response.streaming_content = self.stream(response.streaming_content, request, response, recorder, started)
+        else:
+            self.record(request, response, recorder, started, len(response.content))
+        return response
+
+    def stream(self, content, request, response, recorder, started):
+        size = 0
+        try:
+            with recorder.wrap():
+                for chunk in content:
+                    size += len(chunk)
+                    yield chunk
+        finally:
+            self.record(request, response, recorder, started, size)
+
+    async def astream(self, content, request, response, recorder, started):
+        size = 0
+        # Entered and closed in the sync thread, where the chunks run their queries
+        stack = await sync_to_async(recorder.wrap)()
+        try:
+            async for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            await sync_to_async(stack.close)()
+            self.record(request, response, recorder, started, size)
+
+    def record(self, request, response, recorder, started, size):
+        duration = time.perf_counter() - started
+        match = request.resolver_match
+        # Unresolved paths share one label so scanners cannot blow up cardinality
+        view = match.view_name if match else 'unmatched'
+        metrics.request_duration.observe(duration, view=view, method=request.method)
+        metrics.requests_total.inc(view=view, method=request.method, status=response.status_code)
+        metrics.request_queries.observe(recorder.count, view=view)
+        metrics.request_query_duration.observe(recorder.duration, view=view)
+        metrics.response_size.observe(size, view=view)
+
+        config = settings.METRICS
+        if duration < config['SLOW_REQUEST_SECONDS']:
+            return
+        metrics.slow_requests_total.inc(view=view)
+        if random.random() >= config['SLOW_SAMPLE_RATE']:
+            return
+        sample = {
+            'time': timezone.now().isoformat(),
+            'view': view,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'seconds': round(duration, 4),
+            'query_count': recorder.count,
+            'query_seconds': round(recorder.duration, 4),
+            'queries': recorder.queries,
+        }
+        metrics.slow_samples.append(sample)
+        logger.warning(
+            'Slow request %s %s (%s): %.3fs, %d queries in %.3fs',
+            request.method, request.path, view, duration, recorder.count, recorder.duration,
+            extra={'queries': recorder.queries},
+        )
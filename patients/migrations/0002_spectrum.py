@@ -0,0 +1,71 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+import numpy as np
+
+
+def pack_spectral_points(apps, schema_editor):
+    """Pack each session's SpectralPoint rows into a single Spectrum."""
+    SpectralPoint = apps.get_model('patients', 'SpectralPoint')
+    Spectrum = apps.get_model('patients', 'Spectrum')
+    session_ids = (
+        SpectralPoint.objects.order_by('session_id')
+        .values_list('session_id', flat=True)
+        .distinct()
+    )
+    for session_id in list(session_ids):
+        points = SpectralPoint.objects.filter(session_id=session_id).order_by('id')
+        rows = np.array(list(points.values_list('wavelength', 'intensity')), dtype='<f8')
+        # Keep the earliest reading for a wavelength, as ingestion did
+        wavelengths, first = np.unique(rows[:, 0], return_index=True)
+        intensities = rows[first, 1]
+        Spectrum.objects.create(
+            session_id=session_id,
+            dtype='<f8',
+            point_count=wavelengths.size,
+            wavelengths=wavelengths.tobytes(),
+            intensities=intensities.tobytes(),
+        )
+        points.delete()
+
+
+def unpack_spectra(apps, schema_editor):
+    """Expand each Spectrum back into SpectralPoint rows."""
+    SpectralPoint = apps.get_model('patients', 'SpectralPoint')
+    Spectrum = apps.get_model('patients', 'Spectrum')
+    for spectrum in Spectrum.objects.iterator():
+        wavelengths = np.frombuffer(spectrum.wavelengths, dtype=spectrum.dtype)
+        intensities = np.frombuffer(spectrum.intensities, dtype=spectrum.dtype)
+        SpectralPoint.objects.bulk_create(
+            SpectralPoint(session_id=spectrum.session_id, wavelength=wavelength, intensity=intensity)
+            for wavelength, intensity in zip(wavelengths.tolist(), intensities.tolist())
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Spectrum',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dtype', models.CharField(choices=[('<f4', 'float32'), ('<f8', 'float64')], default='<f8', max_length=3)),
+                ('point_count', models.PositiveIntegerField(default=0)),
+                ('wavelengths', models.BinaryField(default=bytes)),
+                ('intensities', models.BinaryField(default=bytes)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('session', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='spectrum', to='patients.measurementsession')),
+            ],
+            options={
+                'verbose_name': 'Spectrum',
+                'verbose_name_plural': 'Spectra',
+            },
+        ),
+        migrations.RunPython(pack_spectral_points, unpack_spectra),
+    ]
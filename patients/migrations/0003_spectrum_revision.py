@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:19
+
+from django.db import migrations, models
+import numpy as np
+
+
+def tag_existing_points(apps, schema_editor):
+    """Treat every point stored so far as part of revision 1."""
+    Spectrum = apps.get_model('patients', 'Spectrum')
+    for spectrum in Spectrum.objects.filter(point_count__gt=0).iterator():
+        spectrum.revision = 1
+        spectrum.revisions = np.ones(spectrum.point_count, dtype='<u4').tobytes()
+        spectrum.save(update_fields=['revision', 'revisions'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0002_spectrum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='spectrum',
+            name='revision',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='spectrum',
+            name='revisions',
+            field=models.BinaryField(default=bytes),
+        ),
+        migrations.RunPython(tag_existing_points, migrations.RunPython.noop),
+    ]
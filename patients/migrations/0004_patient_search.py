@@ -0,0 +1,69 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:24
+
+from django.db import migrations, models
+from django.db.utils import OperationalError
+
+FTS_COLUMNS = 'name, patient_id, phone_number, email, clinical_notes'
+NEW_VALUES = 'new.id, new.name, new.patient_id, new.phone_number, new.email, new.clinical_notes'
+OLD_VALUES = 'old.id, old.name, old.patient_id, old.phone_number, old.email, old.clinical_notes'
+
+CREATE_FTS = [
+    f"""CREATE VIRTUAL TABLE patients_patient_fts USING fts5(
+        {FTS_COLUMNS}, content='patients_patient', content_rowid='id', prefix='2 3'
+    )""",
+    f"""CREATE TRIGGER patients_patient_fts_insert AFTER INSERT ON patients_patient BEGIN
+        INSERT INTO patients_patient_fts(rowid, {FTS_COLUMNS}) VALUES ({NEW_VALUES});
+    END""",
+    f"""CREATE TRIGGER patients_patient_fts_delete AFTER DELETE ON patients_patient BEGIN
+        INSERT INTO patients_patient_fts(patients_patient_fts, rowid, {FTS_COLUMNS}) VALUES ('delete', {OLD_VALUES});
+    END""",
+    f"""CREATE TRIGGER patients_patient_fts_update AFTER UPDATE ON patients_patient BEGIN
+        INSERT INTO patients_patient_fts(patients_patient_fts, rowid, {FTS_COLUMNS}) VALUES ('delete', {OLD_VALUES});
+        INSERT INTO patients_patient_fts(rowid, {FTS_COLUMNS}) VALUES ({NEW_VALUES});
+    END""",
+    "INSERT INTO patients_patient_fts(patients_patient_fts) VALUES ('rebuild')",
+]
+
+DROP_FTS = [
+    'DROP TRIGGER IF EXISTS patients_patient_fts_insert',
+    'DROP TRIGGER IF EXISTS patients_patient_fts_delete',
+    'DROP TRIGGER IF EXISTS patients_patient_fts_update',
+    'DROP TABLE IF EXISTS patients_patient_fts',
+]
+
+
+def create_fts_index(apps, schema_editor):
+    """Create the FTS5 patient index on SQLite builds that support it.
+
+    Other databases, and SQLite without FTS5, fall back to LIKE searches.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(CREATE_FTS[0])
+    except OperationalError:
+        return
+    for statement in CREATE_FTS[1:]:
+        schema_editor.execute(statement)
+
+
+def drop_fts_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in DROP_FTS:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0003_spectrum_revision'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['name', 'id'], name='patient_name_id_idx'),
+        ),
+        migrations.RunPython(create_fts_index, drop_fts_index),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:25
+
+from django.db import migrations, models
+import re
+
+
+def seed_patient_sequence(apps, schema_editor):
+    """Start the counter after the highest patient ID already issued."""
+    Patient = apps.get_model('patients', 'Patient')
+    PatientIdSequence = apps.get_model('patients', 'PatientIdSequence')
+    last_value = 0
+    for patient_id in Patient.objects.values_list('patient_id', flat=True).iterator():
+        match = re.fullmatch(r'PID(\d+)', patient_id or '')
+        if match:
+            last_value = max(last_value, int(match.group(1)))
+    PatientIdSequence.objects.update_or_create(name='patient', defaults={'last_value': last_value})
+
+
+FTS_COLUMNS = 'name, patient_id, phone_number, email, clinical_notes'
+NEW_VALUES = 'new.id, new.name, new.patient_id, new.phone_number, new.email, new.clinical_notes'
+OLD_VALUES = 'old.id, old.name, old.patient_id, old.phone_number, old.email, old.clinical_notes'
+
+# The triggers from 0004 that keep the patient search index in sync
+FTS_TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS patients_patient_fts_insert AFTER INSERT ON patients_patient BEGIN
+        INSERT INTO patients_patient_fts(rowid, {FTS_COLUMNS}) VALUES ({NEW_VALUES});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS patients_patient_fts_delete AFTER DELETE ON patients_patient BEGIN
+        INSERT INTO patients_patient_fts(patients_patient_fts, rowid, {FTS_COLUMNS}) VALUES ('delete', {OLD_VALUES});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS patients_patient_fts_update AFTER UPDATE ON patients_patient BEGIN
+        INSERT INTO patients_patient_fts(patients_patient_fts, rowid, {FTS_COLUMNS}) VALUES ('delete', {OLD_VALUES});
+        INSERT INTO patients_patient_fts(rowid, {FTS_COLUMNS}) VALUES ({NEW_VALUES});
+    END""",
+]
+
+
+def restore_fts_triggers(apps, schema_editor):
+    """Re-create the search triggers dropped when SQLite rebuilt the patient table.
+
+    SQLite applies the patient_id AlterField above by copying the table, and
+    triggers do not survive the copy. Row IDs do, so the index itself is intact.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    if 'patients_patient_fts' not in schema_editor.connection.introspection.table_names():
+        return
+    for statement in FTS_TRIGGERS:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0004_patient_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientIdSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_value', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Patient ID Sequence',
+                'verbose_name_plural': 'Patient ID Sequences',
+            },
+        ),
+        # Reversing the AlterField rebuilds the table too, so restore the triggers after it
+        migrations.RunPython(migrations.RunPython.noop, restore_fts_triggers),
+        migrations.AlterField(
+            model_name='patient',
+            name='patient_id',
+            field=models.CharField(blank=True, editable=False, help_text='Unique identifier for the patient', max_length=10, unique=True, verbose_name='Patient ID'),
+        ),
+        migrations.RunPython(restore_fts_triggers, migrations.RunPython.noop),
+        migrations.RunPython(seed_patient_sequence, migrations.RunPython.noop),
+    ]
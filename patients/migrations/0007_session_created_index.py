@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 00:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0006_outbound_email'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='measurementsession',
+            index=models.Index(fields=['-created_at'], name='session_created_idx'),
+        ),
+    ]
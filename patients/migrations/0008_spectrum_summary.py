@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-17 01:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0007_session_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='spectrum',
+            name='area',
+            field=models.FloatField(blank=True, help_text='Intensity integrated over wavelength (trapezoidal rule)', null=True),
+        ),
+        migrations.AddField(
+            model_name='spectrum',
+            name='intensity_max',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='spectrum',
+            name='intensity_mean',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='spectrum',
+            name='intensity_min',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='spectrum',
+            name='peak_wavelength',
+            field=models.FloatField(blank=True, help_text='Wavelength of the highest intensity', null=True),
+        ),
+        migrations.AddField(
+            model_name='spectrum',
+            name='wavelength_max',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='spectrum',
+            name='wavelength_min',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
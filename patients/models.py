@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth import get_user_model
 from django.utils import timezone
+import numpy as np
 import uuid
 
 User = get_user_model()
@@ -71,24 +72,53 @@ class UserProfile(models.Model):
         """Check if user has access to a specific device"""
         return self.is_admin or self.devices.filter(pk=device.pk).exists()
 
+class PatientIdSequence(models.Model):
+    """Counter that hands out patient ID numbers without scanning the Patient table"""
+    name = models.CharField(max_length=50, unique=True)
+    last_value = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = 'Patient ID Sequence'
+        verbose_name_plural = 'Patient ID Sequences'
+
+    def __str__(self):
+        return f"{self.name}: {self.last_value}"
+
+    @classmethod
+    def allocate(cls, count=1, name='patient'):
+        """Reserve count consecutive numbers and return the first one.
+        
+        The UPDATE locks the counter row until the transaction ends, so
+        concurrent callers always receive disjoint ranges.
+        """
+        from django.db import transaction
+        from django.db.models import F
+
+        with transaction.atomic():
+            counter = cls.objects.filter(name=name)
+            if not counter.update(last_value=F('last_value') + count):
+                cls.objects.get_or_create(name=name)
+                counter.update(last_value=F('last_value') + count)
+            last_value = counter.values_list('last_value', flat=True).get()
+        return last_value - count + 1
+
+def format_patient_id(number):
+    """Format a patient ID number as PID000001"""
+    return f"PID{number:06d}"
+
+def reserve_patient_ids(count):
+    """Return a list of count new patient IDs allocated in one step"""
+    first = PatientIdSequence.allocate(count)
+    return [format_patient_id(number) for number in range(first, first + count)]
+
 def generate_patient_id():
     """Generate a new patient ID in the format PID000001"""
-    from django.db.models import Max
-    from django.db.models.functions import Substr, Cast
-    from django.db.models import IntegerField
-    
-    # Get the highest existing PID number
-    max_pid = Patient.objects.annotate(
-        pid_num=Cast(Substr('patient_id', 4), output_field=IntegerField())
-    ).aggregate(max_pid=Max('pid_num'))['max_pid']
-    
-    # If no patients exist yet, start from 1, otherwise increment the max
-    new_number = 1 if max_pid is None else max_pid + 1
-    
-    # Format as PID with leading zeros
-    return f"PID{new_number:06d}"
+    return format_patient_id(PatientIdSequence.allocate())
 
 class Patient(models.Model):
+    # SQLite applies most AlterFields on this model by rebuilding the table, which
+    # drops the search index triggers from migration 0004; such migrations must
+    # re-create them afterwards, as 0005 does.
     GENDER_CHOICES = [
         ('M', 'Male'),
         ('F', 'Female'),
@@ -99,9 +129,9 @@ class Patient(models.Model):
     patient_id = models.CharField(
         max_length=10,
         unique=True,
+        blank=True,
         help_text='Unique identifier for the patient',
         verbose_name='Patient ID',
-        default=generate_patient_id,
         editable=False
     )
     device = models.ForeignKey(Device, on_delete=models.SET_NULL, null=True, blank=True, related_name='patients')
@@ -154,11 +184,18 @@ class Patient(models.Model):
         ordering = ['name']
         verbose_name = 'Patient'
         verbose_name_plural = 'Patients'
+        indexes = [
+            # Keyset pagination in patient_list walks (name, id)
+            models.Index(fields=['name', 'id'], name='patient_name_id_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name} ({self.patient_id})"
         
     def save(self, *args, **kwargs):
+        # Allocate the patient ID on first save so unsaved forms don't use up numbers
+        if not self.patient_id:
+            self.patient_id = generate_patient_id()
         # Auto-calculate age from date_of_birth if provided
         if self.date_of_birth and not self.age:
             from datetime import date
@@ -184,6 +221,9 @@ class MeasurementSession(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at'], name='session_created_idx'),
+        ]
         
     def __str__(self):
         return f"Session {self.session_id} - {self.get_status_display()} - {self.created_at.strftime('%Y-%m-%d %H:%M')}"
@@ -193,7 +233,149 @@ class MeasurementSession(models.Model):
         self.updated_at = timezone.now()
         super().save(*args, **kwargs)
 
+    def get_spectrum(self):
+        """Return the packed spectrum for this session, or None if no data has arrived"""
+        try:
+            return self.spectrum
+        except Spectrum.DoesNotExist:
+            return None
+
+class Spectrum(models.Model):
+    """Spectral data for a session packed into two float arrays sorted by wavelength.
+
+    Deduplication lives here: the one-to-one session column allows one row
+    per session, and ``append`` drops wavelengths already stored, which
+    ``persist_points`` runs with the row locked so concurrent writers cannot
+    duplicate points either.
+
+    ``revision`` counts the writes that added points, and ``revisions`` packs
+    the write each point arrived in, so readers can ask for just the points
+    added after a revision they have already seen.
+
+    The summary fields are kept current by ``append`` so that lists can show
+    them without loading the arrays; ``backfill_spectrum_summaries`` fills
+    them in for spectra written before they existed.
+    """
+    SUMMARY_FIELDS = (
+        'wavelength_min', 'wavelength_max', 'intensity_min', 'intensity_max',
+        'intensity_mean', 'peak_wavelength', 'area',
+    )
+    DTYPE_CHOICES = [
+        ('<f4', 'float32'),
+        ('<f8', 'float64'),
+    ]
+
+    session = models.OneToOneField(MeasurementSession, on_delete=models.CASCADE, related_name='spectrum')
+    dtype = models.CharField(max_length=3, choices=DTYPE_CHOICES, default='<f8')
+    point_count = models.PositiveIntegerField(default=0)
+    wavelengths = models.BinaryField(default=bytes)
+    intensities = models.BinaryField(default=bytes)
+    revision = models.PositiveIntegerField(default=0)
+    revisions = models.BinaryField(default=bytes)
+    wavelength_min = models.FloatField(null=True, blank=True)
+    wavelength_max = models.FloatField(null=True, blank=True)
+    intensity_min = models.FloatField(null=True, blank=True)
+    intensity_max = models.FloatField(null=True, blank=True)
+    intensity_mean = models.FloatField(null=True, blank=True)
+    peak_wavelength = models.FloatField(null=True, blank=True, help_text='Wavelength of the highest intensity')
+    area = models.FloatField(null=True, blank=True, help_text='Intensity integrated over wavelength (trapezoidal rule)')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Spectrum'
+        verbose_name_plural = 'Spectra'
+
+    def __str__(self):
+        return f"Spectrum for session {self.session_id} ({self.point_count} points)"
+
+    def as_arrays(self):
+        """Return read-only (wavelengths, intensities) views over the stored bytes"""
+        dtype = np.dtype(self.dtype)
+        return (
+            np.frombuffer(self.wavelengths, dtype=dtype),
+            np.frombuffer(self.intensities, dtype=dtype),
+        )
+
+    def as_revisions(self):
+        """Return a read-only view of the revision each point was added in"""
+        return np.frombuffer(self.revisions, dtype='<u4')
+
+    def since(self, revision):
+        """Return (wavelengths, intensities) added after the given revision"""
+        wavelengths, intensities = self.as_arrays()
+        newer = self.as_revisions() > revision
+        return wavelengths[newer], intensities[newer]
+
+    def append(self, wavelengths, intensities):
+        """Merge new points into the spectrum and return how many were added.
+
+        Wavelengths that are already stored keep their existing intensity.
+        New points are tagged with the next revision. The caller is
+        responsible for saving the instance.
+        """
+        from .spectra import merge_spectrum
+
+        dtype = np.dtype(self.dtype)
+        wavelengths = np.asarray(wavelengths, dtype=dtype)
+        current_wavelengths, current_intensities = self.as_arrays()
+        merged_wavelengths, (merged_intensities, merged_revisions), added = merge_spectrum(
+            current_wavelengths,
+            (current_intensities, self.as_revisions()),
+            wavelengths,
+            (
+                np.asarray(intensities, dtype=dtype),
+                np.full(wavelengths.size, self.revision + 1, dtype='<u4'),
+            ),
+        )
+        if added:
+            self.update_summary(merged_wavelengths, merged_intensities, merged_revisions > self.revision)
+            self.wavelengths = merged_wavelengths.tobytes()
+            self.intensities = merged_intensities.tobytes()
+            self.revisions = merged_revisions.tobytes()
+            self.point_count = merged_wavelengths.size
+            self.revision += 1
+        return added
+
+    def update_summary(self, wavelengths, intensities, fresh):
+        """Fold the points marked ``fresh`` in the merged arrays into the summary.
+
+        Extremes, mean and peak are updated from the new points alone. The
+        area is recomputed, as points landing between stored wavelengths
+        change their neighbours' segments; the arrays are already in memory.
+        """
+        from .spectra import trapezoid_area
+
+        if not self.point_count or self.intensity_mean is None:
+            self.recompute_summary(wavelengths, intensities)
+            return
+        new_wavelengths = wavelengths[fresh]
+        new_intensities = np.asarray(intensities[fresh], dtype=np.float64)
+        peak = int(np.argmax(new_intensities))
+        if (new_intensities[peak] > self.intensity_max
+                or (new_intensities[peak] == self.intensity_max and new_wavelengths[peak] < self.peak_wavelength)):
+            self.peak_wavelength = float(new_wavelengths[peak])
+        self.wavelength_min = float(wavelengths[0])
+        self.wavelength_max = float(wavelengths[-1])
+        self.intensity_min = min(self.intensity_min, float(new_intensities.min()))
+        self.intensity_max = max(self.intensity_max, float(new_intensities.max()))
+        self.intensity_mean = (
+            (self.intensity_mean * self.point_count + float(new_intensities.sum()))
+            / (self.point_count + new_intensities.size)
+        )
+        self.area = trapezoid_area(wavelengths, intensities)
+
+    def recompute_summary(self, wavelengths=None, intensities=None):
+        """Set the summary fields from the whole spectrum (the stored arrays by default)"""
+        from .spectra import summarize_spectrum
+
+        if wavelengths is None:
+            wavelengths, intensities = self.as_arrays()
+        for name, value in summarize_spectrum(wavelengths, intensities).items():
+            setattr(self, name, value)
+
 class SpectralPoint(models.Model):
+    """Single (wavelength, intensity) reading; superseded by Spectrum and no longer written"""
     session = models.ForeignKey(MeasurementSession, on_delete=models.CASCADE, related_name='spectra')
     wavelength = models.FloatField()
     intensity = models.FloatField()
@@ -201,3 +383,34 @@ class SpectralPoint(models.Model):
 
     class Meta:
         ordering = ['wavelength']
+
+class OutboundEmail(models.Model):
+    """Email waiting to be sent by the send_queued_mail worker"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField(default=list, help_text='List of recipient addresses')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, help_text='Earliest time the worker may (re)try this message')
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        verbose_name = 'Outbound Email'
+        verbose_name_plural = 'Outbound Emails'
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {', '.join(self.to)} ({self.status})"
@@ -0,0 +1,118 @@
+"""Long-lived MQTT client for publishing device control messages."""
+import atexit
+import json
+import logging
+import os
+import threading
+
+import paho.mqtt.client as mqtt
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class ControlPublisher:
+    """One broker connection per process, shared by every request.
+
+    The client's network loop runs in its own thread and reconnects on its
+    own (backing off from 1 to ``max_reconnect_delay`` seconds). ``publish``
+    only hands the message to paho's outbound queue, which holds at most
+    ``max_queued`` QoS 1 messages while the broker is slow or unreachable;
+    messages that do not fit are dropped, logged and counted in ``dropped``.
+    """
+
+    def __init__(self, host, port, keepalive=60, max_queued=1000, max_reconnect_delay=30,
+                 client_factory=mqtt.Client):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.dropped = 0
+        self._client = client_factory()
+        self._client.max_queued_messages_set(max_queued)
+        self._client.reconnect_delay_set(min_delay=1, max_delay=max_reconnect_delay)
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            # connect_async lets the loop thread connect (and retry) without blocking the caller
+            self._client.connect_async(self.host, self.port, self.keepalive)
+            self._client.loop_start()
+            self._started = True
+
+    def stop(self):
+        with self._lock:
+            if not self._started:
+                return
+            self._client.disconnect()
+            self._client.loop_stop()
+            self._started = False
+
+    def is_connected(self):
+        return self._client.is_connected()
+
+    def publish(self, topic, payload, qos=1):
+        """Queue ``payload`` for ``topic``; returns False if it was dropped."""
+        self.start()
+        info = self._client.publish(topic, payload=payload, qos=qos, retain=False)
+        # NO_CONN still queues QoS 1 messages; they go out after reconnecting
+        if info.rc in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+            return True
+        self.dropped += 1
+        logger.error(f"Dropped MQTT message for {topic}: {mqtt.error_string(info.rc)}")
+        return False
+
+    def _on_connect(self, client, userdata, flags, rc, *args):
+        if rc == 0:
+            logger.info(f"Control publisher connected to {self.host}:{self.port}")
+        else:
+            logger.warning(f"Control publisher connection refused: {rc}")
+
+    def _on_disconnect(self, client, userdata, *args):
+        logger.warning(f"Control publisher disconnected from {self.host}:{self.port}; reconnecting")
+
+
+_publisher = None
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    """Return this process's publisher, creating it on first use.
+
+    The pid check gives forked workers their own client instead of sharing
+    the parent's socket.
+    """
+    global _publisher, _publisher_pid
+    with _publisher_lock:
+        if _publisher is None or _publisher_pid != os.getpid():
+            _publisher = ControlPublisher(
+                settings.MQTT['BROKER'],
+                settings.MQTT['PORT'],
+                keepalive=settings.MQTT.get('KEEPALIVE', 60),
+                max_queued=settings.MQTT.get('PUBLISH_QUEUE_SIZE', 1000),
+            )
+            _publisher_pid = os.getpid()
+            atexit.register(_publisher.stop)
+        return _publisher
+
+
+def control_topic(device_id):
+    return f"{settings.MQTT.get('CONTROL_TOPIC_PREFIX', 'device/')}{device_id}/control"
+
+
+def send_control(device_id, payload):
+    """Publish a control message to a device once the current transaction commits.
+
+    Nothing is sent if the transaction rolls back, and no database locks are
+    held while talking to the broker. Outside a transaction it is queued
+    straight away.
+    """
+    topic = control_topic(device_id)
+    message = json.dumps(payload)
+    transaction.on_commit(lambda: get_publisher().publish(topic, message), robust=True)
@@ -0,0 +1,76 @@
+"""Patient search backed by an SQLite FTS5 index, with a LIKE fallback."""
+import base64
+import json
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import Patient
+
+FTS_TABLE = 'patients_patient_fts'
+SEARCH_FIELDS = ('name', 'patient_id', 'phone_number', 'email', 'clinical_notes')
+
+
+def has_fts_index():
+    """Return True if the FTS5 index created by migration 0004 is present."""
+    if connection.vendor != 'sqlite':
+        return False
+    return FTS_TABLE in connection.introspection.table_names()
+
+
+def search_terms(query):
+    """Return the word terms in ``query``; punctuation and FTS syntax are ignored."""
+    return re.findall(r'\w+', query)
+
+
+def search_filter(query):
+    """Return a Q matching patients whose indexed fields start with every term."""
+    terms = search_terms(query)
+    if not terms:
+        return Q()
+    if has_fts_index():
+        # Quoted prefix terms, implicitly ANDed; quoting keeps FTS syntax inert
+        match = ' '.join(f'"{term}"*' for term in terms)
+        return Q(pk__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', (match,)))
+    condition = Q()
+    for term in terms:
+        term_condition = Q()
+        for field in SEARCH_FIELDS:
+            term_condition |= Q(**{f'{field}__icontains': term})
+        condition &= term_condition
+    return condition
+
+
+def encode_cursor(patient):
+    """Opaque keyset cursor pointing just after ``patient`` in (name, id) order."""
+    raw = json.dumps([patient.name, patient.pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor):
+    """Return the (name, id) pair in a cursor; raises ValueError if malformed."""
+    try:
+        name, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f'Invalid cursor: {e}')
+    if not isinstance(name, str) or not isinstance(pk, int):
+        raise ValueError('Invalid cursor')
+    return name, pk
+
+
+def search_patients(query='', after=None, limit=25):
+    """Return one page of patients ordered by (name, id) and the next cursor.
+
+    ``after`` is a cursor from a previous page. Each page is a range scan on
+    the (name, id) index, so deep pages cost the same as the first one. The
+    next cursor is None on the last page.
+    """
+    patients = Patient.objects.filter(search_filter(query)).order_by('name', 'pk')
+    if after:
+        name, pk = decode_cursor(after)
+        patients = patients.filter(Q(name__gt=name) | Q(name=name, pk__gt=pk))
+    page = list(patients[:limit + 1])
+    next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .ingestion import device_cache, session_cache
+from .models import Device, MeasurementSession
+
+
+@receiver([post_save, post_delete], sender=Device)
+def invalidate_cached_device(sender, instance, **kwargs):
+    """Drop a saved or deleted device from the ingestion lookup cache"""
+    device_cache.invalidate(instance.device_id)
+
+
+@receiver([post_save, post_delete], sender=MeasurementSession)
+def invalidate_cached_session(sender, instance, **kwargs):
+    """Drop a saved or deleted session from the ingestion lookup cache"""
+    if instance.session_id:
+        session_cache.invalidate(str(instance.session_id))
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    """Apply settings.SQLITE_PRAGMAS to each new SQLite connection"""
+    if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+        return
+    # The raw cursor keeps these out of query logs and execute wrappers
+    cursor = connection.connection.cursor()
+    try:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+    finally:
+        cursor.close()
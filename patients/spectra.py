@@ -0,0 +1,159 @@
+"""NumPy helpers for whole-spectrum data."""
+import numpy as np
+
+
+def decode_spectrum(data):
+    """Validate a whole-spectrum payload and return it as NumPy arrays.
+
+    ``data`` must carry parallel ``wavelengths`` and ``intensities`` lists of
+    equal, non-zero length with only finite values. Repeated wavelengths are
+    collapsed to their first occurrence. Returns ``(wavelengths, intensities)``
+    as float64 arrays sorted by wavelength; raises ``ValueError`` if the
+    payload is malformed.
+    """
+    try:
+        wavelengths = np.asarray(data['wavelengths'], dtype=np.float64)
+        intensities = np.asarray(data['intensities'], dtype=np.float64)
+    except KeyError as e:
+        raise ValueError(f'Missing field {e}')
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'Spectrum values must be numeric: {e}')
+
+    if wavelengths.ndim != 1 or intensities.ndim != 1:
+        raise ValueError('wavelengths and intensities must be flat arrays')
+    if wavelengths.size != intensities.size:
+        raise ValueError(
+            f'Length mismatch: {wavelengths.size} wavelengths, {intensities.size} intensities'
+        )
+    if wavelengths.size == 0:
+        raise ValueError('Spectrum is empty')
+
+    finite = np.isfinite(wavelengths) & np.isfinite(intensities)
+    if not finite.all():
+        raise ValueError(f'Spectrum contains {int((~finite).sum())} NaN/inf value(s)')
+
+    # np.unique returns the index of the first occurrence of each wavelength
+    wavelengths, first = np.unique(wavelengths, return_index=True)
+    return wavelengths, intensities[first]
+
+
+def merge_spectrum(wavelengths, columns, new_wavelengths, new_columns):
+    """Merge new points into a spectrum sorted by wavelength.
+
+    ``columns`` and ``new_columns`` are sequences of arrays aligned with
+    ``wavelengths`` and ``new_wavelengths`` (intensities, revisions, ...).
+    New wavelengths that are already present, or repeated within the new
+    points, are dropped so that the first value stored wins. Returns
+    ``(wavelengths, columns, added)`` with the merged arrays still sorted.
+    """
+    new_wavelengths, first = np.unique(new_wavelengths, return_index=True)
+    fresh = ~np.isin(new_wavelengths, wavelengths)
+    if not fresh.any():
+        return wavelengths, list(columns), 0
+    new_wavelengths = new_wavelengths[fresh]
+    keep = first[fresh]
+
+    merged_wavelengths = np.concatenate([wavelengths, new_wavelengths])
+    order = np.argsort(merged_wavelengths, kind='stable')
+    merged_columns = [
+        np.concatenate([column, new_column[keep]])[order]
+        for column, new_column in zip(columns, new_columns)
+    ]
+    return merged_wavelengths[order], merged_columns, int(new_wavelengths.size)
+
+
+def trapezoid_area(wavelengths, intensities):
+    """Integrate intensity over wavelength with the trapezoidal rule."""
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    intensities = np.asarray(intensities, dtype=np.float64)
+    if wavelengths.size < 2:
+        return 0.0
+    return float(np.sum(np.diff(wavelengths) * (intensities[1:] + intensities[:-1])) / 2)
+
+
+def summarize_spectrum(wavelengths, intensities):
+    """Return the summary stored on ``Spectrum`` for arrays sorted by wavelength.
+
+    Keys match ``Spectrum.SUMMARY_FIELDS``; every value is None for an empty
+    spectrum. The peak is the lowest wavelength with the highest intensity.
+    """
+    if wavelengths.size == 0:
+        return dict.fromkeys(('wavelength_min', 'wavelength_max', 'intensity_min', 'intensity_max',
+                              'intensity_mean', 'peak_wavelength', 'area'))
+    intensities = np.asarray(intensities, dtype=np.float64)
+    return {
+        'wavelength_min': float(wavelengths[0]),
+        'wavelength_max': float(wavelengths[-1]),
+        'intensity_min': float(intensities.min()),
+        'intensity_max': float(intensities.max()),
+        'intensity_mean': float(intensities.mean()),
+        'peak_wavelength': float(wavelengths[np.argmax(intensities)]),
+        'area': trapezoid_area(wavelengths, intensities),
+    }
+
+
+# Smallest threshold every downsampler can honour (LTTB needs both endpoints and one bucket)
+MIN_DOWNSAMPLE_POINTS = 3
+
+
+def lttb(x, y, threshold):
+    """Downsample to ``threshold`` points with largest-triangle-three-buckets.
+
+    ``threshold`` must be at least 3. The first and last points are kept. Interior points are split into
+    ``threshold - 2`` buckets and each bucket keeps the point forming the
+    largest triangle with the previously kept point and the next bucket's
+    mean. Buckets depend on each other, so they are visited in order, but the
+    work inside each bucket is vectorized.
+    """
+    if threshold < 3:
+        raise ValueError('lttb needs a threshold of at least 3')
+    n = x.size
+    if threshold >= n:
+        return x, y
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.intp)
+    selected = np.empty(threshold, dtype=np.intp)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        if bucket == threshold - 3:
+            next_x, next_y = x[-1], y[-1]
+        else:
+            next_stop = edges[bucket + 2]
+            next_x, next_y = x[stop:next_stop].mean(), y[stop:next_stop].mean()
+        area = np.abs(
+            (x[previous] - next_x) * (y[start:stop] - y[previous])
+            - (x[previous] - x[start:stop]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(area))
+        selected[bucket + 1] = previous
+    return x[selected], y[selected]
+
+
+def minmax(x, y, threshold):
+    """Downsample to at most ``threshold`` points keeping each bucket's extremes.
+
+    Points are split into ``threshold // 2`` equal buckets (one per chart
+    pixel column when ``threshold`` is twice the width) and the minimum and
+    maximum of each bucket are kept in their original order. ``threshold``
+    must be at least 2. Fully vectorized.
+    """
+    if threshold < 2:
+        raise ValueError('minmax needs a threshold of at least 2')
+    n = x.size
+    if threshold >= n:
+        return x, y
+
+    edges = np.linspace(0, n, threshold // 2 + 1).astype(np.intp)
+    buckets = np.repeat(np.arange(edges.size - 1), np.diff(edges))
+    # Sort by intensity within each bucket: first is the minimum, last the maximum
+    order = np.lexsort((y, buckets))
+    selected = np.unique(np.concatenate([order[edges[:-1]], order[edges[1:] - 1]]))
+    return x[selected], y[selected]
+
+
+DOWNSAMPLERS = {
+    'lttb': lttb,
+    'minmax': minmax,
+}
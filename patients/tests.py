@@ -0,0 +1,652 @@
+import io
+import json
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date
+from unittest import mock
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from . import ingestion, mqtt, search
+from .async_ingestion import lane_for
+from .importing import PatientImporter, read_csv
+from .ingestion import (
+    FrameCoalescer, backfill_spectrum_summaries, IdleSessionSweeper, LookupCache, SpectralBuffer, device_cache, persist_points, session_cache,
+)
+from .mail import claim_batch, enqueue_email, send_batch, send_due
+from .management.commands.run_mqtt import Command as RunMqttCommand
+from .models import (
+    Device, MeasurementSession, OutboundEmail, Patient, PatientIdSequence, Spectrum, UserProfile,
+    reserve_patient_ids,
+)
+from .search import has_fts_index, search_patients
+from .spectra import decode_spectrum, lttb, minmax
+
+
+class IngestionTestCase(TestCase):
+    def setUp(self):
+        device_cache.clear()
+        session_cache.clear()
+        self.patient = Patient.objects.create(name='Test Patient')
+        self.device = Device.objects.create(device_id='DEV-T', name='Test device')
+        self.session = MeasurementSession.objects.create(patient=self.patient, device=self.device)
+
+    def consumer(self, batch_size=1):
+        command = RunMqttCommand(stdout=io.StringIO(), stderr=io.StringIO())
+        command.buffer = SpectralBuffer(max_points=batch_size, max_delay=60, on_flush=command.on_flush)
+        command.sweeper = IdleSessionSweeper(idle_timeout=60)
+        command.frames = FrameCoalescer(lambda session_id, text: None)
+        return command
+
+    def send(self, command, data, session=None):
+        session = session or self.session
+        command.process_spectral_data(self.device.device_id, str(session.session_id), json.dumps(data).encode())
+
+
+class SessionCompletionTests(IngestionTestCase):
+    def test_messages_after_a_flush_are_kept(self):
+        command = self.consumer(batch_size=1)
+        for wavelength in (400.0, 401.0, 402.0):
+            self.send(command, {'wavelength': wavelength, 'intensity': 1.0})
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.status, 'in_progress')
+        self.assertEqual(Spectrum.objects.get(session=self.session).point_count, 3)
+
+    def test_complete_message_flushes_and_completes(self):
+        command = self.consumer(batch_size=100)
+        self.send(command, {'wavelengths': [400.0, 401.0], 'intensities': [1.0, 2.0]})
+        self.send(command, {'wavelength': 402.0, 'intensity': 3.0, 'complete': True})
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.status, 'completed')
+        self.assertEqual(Spectrum.objects.get(session=self.session).point_count, 3)
+
+        # Later messages for the completed session are rejected
+        with self.assertLogs('patients.management.commands.run_mqtt', 'WARNING') as logs:
+            self.send(command, {'wavelength': 403.0, 'intensity': 4.0})
+        self.assertIn('already completed', logs.output[0])
+        command.buffer.flush()
+        self.assertEqual(Spectrum.objects.get(session=self.session).point_count, 3)
+
+    def test_idle_sweep_completes_only_idle_sessions(self):
+        busy = MeasurementSession.objects.create(patient=self.patient, device=self.device)
+        written = persist_points([(self.session, [400.0], [1.0]), (busy, [400.0], [1.0])])
+        sweeper = IdleSessionSweeper(idle_timeout=0)
+        sweeper.touch(written)
+        Spectrum.objects.filter(session=busy).update(updated_at='2999-01-01T00:00:00Z')
+
+        self.assertEqual(sweeper.sweep(), 1)
+        self.session.refresh_from_db()
+        busy.refresh_from_db()
+        self.assertEqual(self.session.status, 'completed')
+        self.assertEqual(busy.status, 'in_progress')
+
+
+class WorkerSubscriptionTests(IngestionTestCase):
+    def test_share_group_subscribes_through_shared_subscription(self):
+        client = mock.Mock()
+        command = self.consumer()
+        command.on_connect(client, None, {}, 0)
+        command.share_group = 'ingest'
+        command.on_connect(client, None, {}, 0)
+
+        self.assertEqual(
+            [call.args[0] for call in client.subscribe.call_args_list],
+            ['+/+/measurements', '$share/ingest/+/+/measurements'],
+        )
+
+    def test_similar_device_ids_spread_over_lanes(self):
+        self.assertEqual({lane_for(f'D{index}', 4) for index in range(8)}, {0, 1, 2, 3})
+
+
+class ReconcileSessionsTests(IngestionTestCase):
+    def test_only_sessions_with_idle_data_are_completed(self):
+        idle = MeasurementSession.objects.create(patient=self.patient, device=self.device)
+        persist_points([(self.session, [400.0], [1.0]), (idle, [400.0], [1.0])])
+        Spectrum.objects.filter(session=idle).update(updated_at='2000-01-01T00:00:00Z')
+
+        call_command('reconcile_sessions', stdout=io.StringIO())
+
+        self.session.refresh_from_db()
+        idle.refresh_from_db()
+        self.assertEqual(self.session.status, 'in_progress')
+        self.assertEqual(idle.status, 'completed')
+
+
+class StaleSessionTests(IngestionTestCase):
+    def test_deleted_session_does_not_lose_other_sessions_points(self):
+        stale = MeasurementSession.objects.create(patient=self.patient, device=self.device)
+        buffer = SpectralBuffer(max_points=100)
+        buffer.add(stale, 400.0, 1.0)
+        buffer.add(self.session, 400.0, 2.0)
+        # Deleted while the lookup cache still hands out the instance
+        MeasurementSession.objects.filter(pk=stale.pk).delete()
+
+        with self.assertLogs('patients.ingestion', 'WARNING') as logs:
+            written = buffer.flush()
+        self.assertIn('no longer exists', logs.output[0])
+
+        self.assertEqual(list(written), [self.session])
+        self.assertEqual(Spectrum.objects.get(session=self.session).point_count, 1)
+        self.assertFalse(Spectrum.objects.filter(session_id=stale.pk).exists())
+        self.assertEqual(len(buffer), 0)
+
+    def test_integrity_error_falls_back_to_per_session_writes(self):
+        other = MeasurementSession.objects.create(patient=self.patient, device=self.device)
+        buffer = SpectralBuffer(max_points=100)
+        buffer.add(self.session, 400.0, 1.0)
+        buffer.add(other, 400.0, 2.0)
+        real = ingestion.persist_points
+
+        def fail_whole_batch(batch):
+            if len({session.pk for session, _, _ in batch}) > 1 or batch[0][0] == other:
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            return real(batch)
+
+        with mock.patch.object(ingestion, 'persist_points', side_effect=fail_whole_batch), \
+                self.assertLogs('patients.ingestion', 'WARNING'):
+            written = buffer.flush()
+
+        self.assertEqual(list(written), [self.session])
+        self.assertEqual(Spectrum.objects.get(session=self.session).point_count, 1)
+
+
+class ExportStreamingTests(IngestionTestCase):
+    def setUp(self):
+        super().setUp()
+        persist_points([(self.session, [400.0, 401.0, 402.0], [1.0, 2.0, 3.0])])
+        self.user = User.objects.create_user('exporter', password='secret')
+        self.url = reverse('patients:export_csv', args=[self.session.session_id])
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+        self.expected = b'wavelength,intensity\n400.0,1.0\n401.0,2.0\n402.0,3.0\n'
+
+    def test_wsgi_export_streams_sync_chunks(self):
+        response = self.client.get(self.url)
+
+        self.assertFalse(response.is_async)
+        self.assertEqual(b''.join(response.streaming_content), self.expected)
+
+    def test_archive_export_holds_one_csv_per_matching_session(self):
+        other = MeasurementSession.objects.create(patient=self.patient, device=self.device)
+        persist_points([(other, [500.0], [5.0])])
+        elsewhere = Device.objects.create(device_id='DEV-X', name='Other device')
+        excluded = MeasurementSession.objects.create(patient=self.patient, device=elsewhere)
+        persist_points([(excluded, [600.0], [6.0])])
+
+        response = self.client.get(reverse('patients:export_sessions'), {'format': 'zip', 'device': 'DEV-T'})
+
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(sorted(archive.namelist()), sorted(
+            f'session_{session.session_id}.csv' for session in (self.session, other)
+        ))
+        self.assertEqual(archive.read(f'session_{self.session.session_id}.csv'), self.expected)
+        self.assertEqual(archive.read(f'session_{other.session_id}.csv'), b'wavelength,intensity\n500.0,5.0\n')
+        self.assertIsNone(archive.testzip())
+
+    async def test_asgi_export_streams_async_chunks(self):
+        response = await self.async_client.get(self.url)
+
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), self.expected)
+
+
+class PatientImportTests(TestCase):
+    def run_import(self, text, batch_size=10):
+        return PatientImporter(batch_size=batch_size).run(read_csv(io.StringIO(text)))
+
+    def test_valid_rows_are_imported_with_ids_and_ages(self):
+        today = date.today()
+        importer = self.run_import(f'name,date_of_birth\nAda,{today.year - 30}-01-01\nBo,\n')
+
+        self.assertEqual((importer.imported, importer.errors), (2, []))
+        ada = Patient.objects.get(name='Ada')
+        self.assertEqual(ada.age, 30)
+        self.assertTrue(ada.patient_id)
+        self.assertNotEqual(ada.patient_id, Patient.objects.get(name='Bo').patient_id)
+
+    def test_invalid_rows_are_reported_by_row_number(self):
+        importer = self.run_import('name,email\n,a@example.com\nCy,not-an-email\nDee,\n')
+
+        self.assertEqual(importer.imported, 1)
+        self.assertEqual([row for row, _ in importer.errors], [2, 3])
+        self.assertIn('name:', importer.errors[0][1])
+        self.assertIn('email:', importer.errors[1][1])
+
+    def test_future_and_implausible_birth_dates_are_rejected_per_row(self):
+        future = date.today().replace(year=date.today().year + 1, month=1, day=1)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as file:
+            file.write(f'name,date_of_birth\nEd,{future}\nFay,1500-01-01\nGus,1990-05-05\n')
+            file.flush()
+            call_command('import_patients', file.name, stdout=stdout, stderr=stderr)
+
+        self.assertEqual(list(Patient.objects.values_list('name', flat=True)), ['Gus'])
+        self.assertIn('Row 2: date_of_birth: Date of birth cannot be in the future', stderr.getvalue())
+        self.assertIn('Row 3: date_of_birth: Date of birth cannot be more than 150 years ago', stderr.getvalue())
+        self.assertIn('Imported 1 patient(s); 2 row(s) rejected', stdout.getvalue())
+
+    def test_rejected_batch_falls_back_to_row_by_row_inserts(self):
+        importer = PatientImporter()
+        importer.write_batch([(2, Patient(name='Hal')), (3, Patient(name='Ida', age=-1)), (4, Patient(name='Jo'))])
+
+        self.assertEqual(importer.imported, 2)
+        self.assertEqual([row for row, _ in importer.errors], [3])
+        self.assertEqual(sorted(Patient.objects.values_list('name', flat=True)), ['Hal', 'Jo'])
+
+
+class SpectrumAppendTests(TestCase):
+    def test_append_merges_sorted_and_keeps_first_value(self):
+        spectrum = Spectrum()
+        self.assertEqual(spectrum.append([402.0, 400.0, 400.0], [3.0, 1.0, 9.0]), 2)
+        self.assertEqual(spectrum.append([401.0, 402.0], [2.0, 8.0]), 1)
+
+        wavelengths, intensities = spectrum.as_arrays()
+        self.assertEqual(wavelengths.tolist(), [400.0, 401.0, 402.0])
+        self.assertEqual(intensities.tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual((spectrum.point_count, spectrum.revision), (3, 2))
+
+    def test_append_of_known_wavelengths_changes_nothing(self):
+        spectrum = Spectrum()
+        spectrum.append([400.0, 401.0], [1.0, 2.0])
+        stored = bytes(spectrum.wavelengths), bytes(spectrum.intensities)
+
+        self.assertEqual(spectrum.append([401.0, 400.0], [5.0, 5.0]), 0)
+        self.assertEqual((bytes(spectrum.wavelengths), bytes(spectrum.intensities)), stored)
+        self.assertEqual(spectrum.revision, 1)
+
+
+class IncrementalDataTests(IngestionTestCase):
+    def test_since_returns_points_added_after_a_revision(self):
+        persist_points([(self.session, [400.0, 402.0], [1.0, 3.0])])
+        spectrum = persist_points([(self.session, [401.0, 402.0], [2.0, 9.0])])[self.session]
+
+        wavelengths, intensities = spectrum.since(1)
+        self.assertEqual((wavelengths.tolist(), intensities.tolist()), ([401.0], [2.0]))
+        self.assertEqual(spectrum.since(0)[0].tolist(), [400.0, 401.0, 402.0])
+        self.assertEqual(spectrum.since(spectrum.revision)[0].tolist(), [])
+
+    def test_session_data_returns_delta_and_revision(self):
+        persist_points([(self.session, [400.0], [1.0])])
+        persist_points([(self.session, [401.0], [2.0])])
+        self.client.force_login(User.objects.create_user('viewer', password='secret'))
+        url = reverse('patients:session_data', args=[self.session.session_id])
+
+        data = self.client.get(url, {'since': 1}).json()
+        self.assertEqual((data['wavelengths'], data['intensities']), ([401.0], [2.0]))
+        self.assertEqual((data['revision'], data['point_count'], data['since']), (2, 2, 1))
+        self.assertEqual(self.client.get(url, {'since': -1}).status_code, 400)
+
+    def test_session_data_rejects_caps_below_the_downsamplers_minimum(self):
+        persist_points([(self.session, np.arange(10.0), np.arange(10.0))])
+        self.client.force_login(User.objects.create_user('viewer', password='secret'))
+        url = reverse('patients:session_data', args=[self.session.session_id])
+
+        for params in ({'max_points': 1}, {'max_points': 2}, {'width': 1}):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+        for method in ('lttb', 'minmax'):
+            data = self.client.get(url, {'max_points': 3, 'method': method}).json()
+            self.assertLessEqual(len(data['wavelengths']), 3)
+
+
+class LookupCacheTests(IngestionTestCase):
+    def test_hits_expire_and_least_recently_used_is_evicted(self):
+        loads = []
+        cache = LookupCache(lambda key: loads.append(key) or key.upper(), max_size=2, ttl=60)
+        self.assertEqual([cache.get('a'), cache.get('a'), cache.get('b')], ['A', 'A', 'B'])
+        cache.get('a')
+        cache.get('c')
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(loads, ['a', 'b', 'c', 'b'])
+
+        expiring = LookupCache(lambda key: loads.append(key), ttl=0)
+        expiring.get('d')
+        expiring.get('d')
+        self.assertEqual(loads[-2:], ['d', 'd'])
+
+    def test_failed_loads_are_not_cached(self):
+        with self.assertRaises(Device.DoesNotExist):
+            device_cache.get('DEV-MISSING')
+        Device.objects.create(device_id='DEV-MISSING', name='Late device')
+        self.assertEqual(device_cache.get('DEV-MISSING').name, 'Late device')
+
+    def test_saving_or_deleting_invalidates_cached_rows(self):
+        session_id = str(self.session.session_id)
+        self.assertEqual(session_cache.get(session_id).status, 'in_progress')
+        self.session.status = 'completed'
+        self.session.save()
+        self.assertEqual(session_cache.get(session_id).status, 'completed')
+
+        device_cache.get('DEV-T')
+        self.device.delete()
+        with self.assertRaises(Device.DoesNotExist):
+            device_cache.get('DEV-T')
+
+
+class FrameCoalescerTests(TestCase):
+    def setUp(self):
+        self.sent = []
+        self.frames = FrameCoalescer(lambda session_id, text: self.sent.append(json.loads(text)), interval=60, max_points=2)
+
+    def push(self, revision, point_count, wavelengths):
+        spectrum = mock.Mock(revision=revision, point_count=point_count)
+        self.frames.push('s1', spectrum, np.array(wavelengths), np.ones(len(wavelengths)))
+
+    def test_writes_between_releases_are_merged_and_split_by_max_points(self):
+        self.push(3, 2, [400.0])
+        self.push(4, 3, [401.0, 402.0])
+        self.frames.release()
+
+        self.assertEqual([frame['wavelengths'] for frame in self.sent], [[400.0, 401.0], [402.0]])
+        self.assertEqual({(frame['since'], frame['revision'], frame['point_count']) for frame in self.sent}, {(2, 4, 3)})
+
+    def test_sessions_are_throttled_until_the_interval_passes(self):
+        self.push(1, 1, [400.0])
+        self.frames.release()
+        self.push(2, 2, [401.0])
+        self.frames.release()
+        self.assertEqual(len(self.sent), 1)
+
+        self.frames.release(force=True)
+        self.assertEqual(self.sent[-1]['wavelengths'], [401.0])
+
+
+class PatientSearchTests(TestCase):
+    def setUp(self):
+        for name in ('Ann Lee', 'Ann Lee', 'Ann Lee', 'Bob Stone', 'Cara Annis'):
+            Patient.objects.create(name=name, clinical_notes='routine scan')
+
+    def names(self, query):
+        return [patient.name for patient in search_patients(query, limit=10)[0]]
+
+    def test_keyset_pages_cover_every_match_once(self):
+        seen, cursor = [], None
+        while True:
+            page, cursor = search_patients('', after=cursor, limit=2)
+            seen.extend(patient.pk for patient in page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, list(Patient.objects.order_by('name', 'pk').values_list('pk', flat=True)))
+
+    def test_patients_inserted_after_migrating_are_indexed(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'patients_patient_fts_%'")
+            triggers = sorted(name for name, in cursor.fetchall())
+        self.assertEqual(triggers, [f'patients_patient_fts_{event}' for event in ('delete', 'insert', 'update')])
+
+        Patient.objects.create(name='Zed Quill')
+        self.assertEqual(self.names('quil'), ['Zed Quill'])
+
+    def test_malformed_cursor_is_rejected(self):
+        with self.assertRaises(ValueError):
+            search_patients('', after='not-a-cursor')
+
+    def test_index_matches_term_prefixes_and_follows_updates(self):
+        self.assertTrue(has_fts_index())
+        self.assertEqual(self.names('ann'), ['Ann Lee', 'Ann Lee', 'Ann Lee', 'Cara Annis'])
+        self.assertEqual(self.names('ann lee'), ['Ann Lee'] * 3)
+
+        # The triggers keep the index in sync with updates and deletes
+        Patient.objects.filter(name='Bob Stone').update(name='Bob Annable')
+        self.assertIn('Bob Annable', self.names('ann'))
+        Patient.objects.filter(name='Cara Annis').delete()
+        self.assertNotIn('Cara Annis', self.names('ann'))
+
+    def test_autocomplete_ignores_queries_without_terms(self):
+        self.client.force_login(User.objects.create_user('searcher', password='secret'))
+        url = reverse('patients:patient_autocomplete')
+
+        self.assertEqual(self.client.get(url, {'q': '"*'}).json(), {'results': []})
+        self.assertEqual(self.client.get(url, {'q': '-- !'}).json(), {'results': []})
+        self.assertEqual(len(self.client.get(url, {'q': 'bob'}).json()['results']), 1)
+
+    def test_like_fallback_matches_the_same_rows(self):
+        with mock.patch.object(search, 'has_fts_index', return_value=False):
+            self.assertEqual(self.names('ann lee'), ['Ann Lee'] * 3)
+            self.assertEqual(self.names('stone'), ['Bob Stone'])
+
+
+class PatientIdSequenceTests(TransactionTestCase):
+    def test_concurrent_allocations_get_disjoint_ranges(self):
+        ranges, errors = [], []
+
+        def allocate():
+            try:
+                for _ in range(10):
+                    while True:
+                        try:
+                            ranges.append(reserve_patient_ids(5))
+                            break
+                        except OperationalError as e:
+                            # The shared-cache test database fails fast where a busy timeout would wait
+                            if 'locked' not in str(e):
+                                raise
+                            time.sleep(0.001)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=allocate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        ids = [patient_id for patient_ids in ranges for patient_id in patient_ids]
+        self.assertEqual(sorted(ids), [f'PID{number:06d}' for number in range(1, 201)])
+        self.assertEqual(PatientIdSequence.objects.get(name='patient').last_value, 200)
+
+    def test_saved_patients_take_the_next_id(self):
+        first = reserve_patient_ids(3)
+        patient = Patient.objects.create(name='Next Patient')
+        self.assertEqual(first, ['PID000001', 'PID000002', 'PID000003'])
+        self.assertEqual(patient.patient_id, 'PID000004')
+
+
+class EmailOutboxTests(TestCase):
+    def test_queued_email_is_sent_by_the_worker(self):
+        enqueue_email('Welcome', 'Plain body', ['a@example.com'], html_body='<p>Body</p>')
+        self.assertEqual(mail.outbox, [])
+
+        self.assertEqual(send_due()['sent'], 1)
+        self.assertEqual(mail.outbox[0].alternatives, [('<p>Body</p>', 'text/html')])
+        self.assertEqual(OutboundEmail.objects.get().status, 'sent')
+        self.assertEqual(send_due()['sent'], 0)
+
+    def test_claimed_messages_are_hidden_until_the_lease_expires(self):
+        enqueue_email('Welcome', 'Body', ['a@example.com'])
+        self.assertEqual(len(claim_batch(10)), 1)
+        self.assertEqual(claim_batch(10), [])
+
+    def test_failed_sends_back_off_then_give_up(self):
+        email = enqueue_email('Welcome', 'Body', ['a@example.com'])
+        broken = mock.Mock(**{'open.side_effect': OSError('connection refused')})
+
+        with self.assertLogs('patients.mail', 'WARNING'):
+            result = send_batch([email], connection=broken, max_attempts=2, backoff=60)
+        email.refresh_from_db()
+        self.assertEqual((result['retried'], email.status, email.attempts), (1, 'pending', 1))
+        self.assertGreater((email.next_attempt_at - email.created_at).total_seconds(), 59)
+        self.assertEqual(email.last_error, 'connection refused')
+
+        with self.assertLogs('patients.mail', 'WARNING'):
+            send_batch([email], connection=broken, max_attempts=2, backoff=60)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), ('failed', 2))
+
+
+@override_settings(METRICS={**settings.METRICS, 'TOKEN': 'scrape-token'})
+class MetricsEndpointTests(TestCase):
+    def setUp(self):
+        self.url = reverse('patients:metrics')
+
+    def login(self, is_admin):
+        user = User.objects.create_user('admin' if is_admin else 'staff', password='secret')
+        UserProfile.objects.create(user=user, is_admin=is_admin)
+        self.client.force_login(user)
+
+    def test_anonymous_requests_are_sent_to_login(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(settings.LOGIN_URL, response['Location'])
+
+    def test_bearer_token_must_match(self):
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer scrape-token').status_code, 200)
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 302)
+
+    def test_only_admin_profiles_may_read(self):
+        self.login(is_admin=False)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+        self.login(is_admin=True)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'http_requests_total', response.content)
+
+    @override_settings(METRICS={**settings.METRICS, 'TOKEN': ''})
+    def test_empty_token_never_matches(self):
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer ').status_code, 302)
+
+
+class DownsamplerTests(TestCase):
+    def setUp(self):
+        self.x = np.linspace(400.0, 800.0, 1001)
+        self.y = np.sin(self.x / 7.0) * 100
+        self.y[137] = 500.0
+        self.y[862] = -500.0
+
+    def test_lttb_keeps_threshold_points_with_both_endpoints(self):
+        x, y = lttb(self.x, self.y, 50)
+        self.assertEqual(x.size, 50)
+        self.assertEqual((x[0], x[-1]), (self.x[0], self.x[-1]))
+        self.assertTrue(np.all(np.diff(x) > 0))
+        self.assertIn(500.0, y)
+        self.assertIn(-500.0, y)
+
+    def test_minmax_keeps_every_bucket_extreme(self):
+        x, y = minmax(self.x, self.y, 50)
+        self.assertLessEqual(x.size, 50)
+        self.assertTrue(np.all(np.diff(x) > 0))
+        edges = np.linspace(0, self.x.size, 26).astype(int)
+        for start, stop in zip(edges[:-1], edges[1:]):
+            bucket_x, bucket_y = self.x[start:stop], self.y[start:stop]
+            inside = (x >= bucket_x[0]) & (x <= bucket_x[-1])
+            self.assertEqual((y[inside].min(), y[inside].max()), (bucket_y.min(), bucket_y.max()))
+
+    def test_small_inputs_pass_through_and_tiny_thresholds_are_refused(self):
+        for downsample in (lttb, minmax):
+            x, y = downsample(self.x[:10], self.y[:10], 50)
+            self.assertEqual(x.size, 10)
+        with self.assertRaises(ValueError):
+            lttb(self.x, self.y, 2)
+        with self.assertRaises(ValueError):
+            minmax(self.x, self.y, 1)
+
+
+class SpectrumSummaryTests(IngestionTestCase):
+    def summary(self, spectrum):
+        return {name: getattr(spectrum, name) for name in Spectrum.SUMMARY_FIELDS}
+
+    def test_incremental_summary_matches_a_full_recompute(self):
+        rng = np.random.default_rng(7)
+        spectrum = Spectrum()
+        for _ in range(5):
+            spectrum.append(rng.uniform(400.0, 800.0, 50), rng.uniform(-1.0, 5.0, 50))
+        # Known wavelengths must not count twice
+        wavelengths, intensities = spectrum.as_arrays()
+        spectrum.append(wavelengths[:10], intensities[:10] + 100)
+        incremental = self.summary(spectrum)
+
+        spectrum.recompute_summary()
+        for name, value in self.summary(spectrum).items():
+            self.assertAlmostEqual(incremental[name], value, places=9, msg=name)
+
+    def test_backfill_fills_missing_summaries(self):
+        persist_points([(self.session, [400.0, 401.0, 402.0], [1.0, 5.0, 3.0])])
+        Spectrum.objects.update(**{name: None for name in Spectrum.SUMMARY_FIELDS})
+
+        self.assertEqual(backfill_spectrum_summaries(), 1)
+        spectrum = Spectrum.objects.get()
+        self.assertEqual((spectrum.peak_wavelength, spectrum.intensity_max, spectrum.area), (401.0, 5.0, 7.0))
+        self.assertEqual(backfill_spectrum_summaries(), 0)
+
+    def test_backfill_skips_rows_whose_revision_changed(self):
+        persist_points([(self.session, [400.0, 401.0], [1.0, 2.0])])
+        Spectrum.objects.update(intensity_mean=None)
+        recompute = Spectrum.recompute_summary
+
+        def recompute_then_ingest(spectrum, *args):
+            recompute(spectrum, *args)
+            # Ingestion writes a new revision after the backfill read the row
+            Spectrum.objects.filter(pk=spectrum.pk).update(revision=spectrum.revision + 1)
+
+        with mock.patch.object(Spectrum, 'recompute_summary', autospec=True, side_effect=recompute_then_ingest):
+            self.assertEqual(backfill_spectrum_summaries(), 0)
+        self.assertIsNone(Spectrum.objects.get().intensity_mean)
+
+
+class ControlMessageTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(mqtt, 'get_publisher')
+        self.publisher = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def test_nothing_is_published_when_the_transaction_rolls_back(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                mqtt.send_control('DEV-T', {'command': 'start'})
+                raise RuntimeError('request failed')
+
+        self.assertEqual(callbacks, [])
+        self.publisher.publish.assert_not_called()
+
+    def test_one_publish_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            mqtt.send_control('DEV-T', {'command': 'start'})
+            self.publisher.publish.assert_not_called()
+
+        self.assertEqual(len(callbacks), 1)
+        self.publisher.publish.assert_called_once_with(mqtt.control_topic('DEV-T'), '{"command": "start"}')
+
+    def test_publish_errors_do_not_reach_the_committing_request(self):
+        self.publisher.publish.side_effect = OSError('broker unreachable')
+        with self.assertLogs('django.test', 'ERROR'):
+            with self.captureOnCommitCallbacks(execute=True):
+                mqtt.send_control('DEV-T', {'command': 'stop'})
+        self.publisher.publish.assert_called_once()
+
+
+class DecodeSpectrumTests(TestCase):
+    def test_values_are_float64_sorted_and_first_repeat_wins(self):
+        wavelengths, intensities = decode_spectrum({'wavelengths': [402, 400, '401.5', 400], 'intensities': [3, 1, 2, 9]})
+
+        self.assertEqual((wavelengths.dtype, intensities.dtype), (np.float64, np.float64))
+        self.assertEqual(wavelengths.tolist(), [400.0, 401.5, 402.0])
+        self.assertEqual(intensities.tolist(), [1.0, 2.0, 3.0])
+
+    def test_malformed_payloads_are_refused(self):
+        cases = {
+            'Length mismatch: 2 wavelengths, 1 intensities': {'wavelengths': [400, 401], 'intensities': [1]},
+            'Missing field': {'wavelengths': [400]},
+            'must be numeric': {'wavelengths': ['blue'], 'intensities': [1]},
+            'flat arrays': {'wavelengths': [[400, 401]], 'intensities': [[1, 2]]},
+            'empty': {'wavelengths': [], 'intensities': []},
+            'NaN/inf': {'wavelengths': [400, None], 'intensities': [1, 2]},
+        }
+        for message, data in cases.items():
+            with self.subTest(message), self.assertRaisesRegex(ValueError, message):
+                decode_spectrum(data)
@@ -7,11 +7,15 @@ urlpatterns = [
     path('', views.dashboard, name='dashboard'),
     path('patients/', views.patient_list, name='patient_list'),
     path('patients/new/', views.patient_create, name='patient_create'),
+    path('patients/autocomplete/', views.patient_autocomplete, name='patient_autocomplete'),
     path('patients/<int:pk>/', views.patient_detail, name='patient_detail'),
     path('patients/<int:pk>/edit/', views.patient_update, name='patient_update'),
     path('patients/<int:pk>/delete/', views.patient_delete, name='patient_delete'),
+    path('sessions/export/', views.export_sessions, name='export_sessions'),
     path('sessions/<uuid:session_id>/', views.session_detail, name='session_detail'),
     path('sessions/<uuid:session_id>/export/csv/', views.export_csv, name='export_csv'),
     path('sessions/<uuid:session_id>/export/xlsx/', views.export_xlsx, name='export_xlsx'),
     path('sessions/<uuid:session_id>/data/', views.session_data, name='session_data'),
+    path('metrics', views.metrics, name='metrics'),
+    path('metrics/slow/', views.slow_requests, name='slow_requests'),
 ]
@@ -1,13 +1,26 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
-from .models import Patient, MeasurementSession, SpectralPoint, Device, UserProfile
+from .models import Patient, MeasurementSession, Device, Spectrum, UserProfile
 from .forms import PatientForm, DeviceForm, UserProfileForm
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth import get_user_model
 from django.conf import settings
-import paho.mqtt.publish as publish
 import uuid, json, io, logging
-from django.http import HttpResponse, JsonResponse, Http404
+from django.http import HttpResponse, JsonResponse, Http404, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
+from django.utils.dateparse import parse_date
+from .exports import EXPORT_FORMATS, accepts_gzip, filter_sessions, iter_csv, iter_spectra, response_chunks
+from .spectra import DOWNSAMPLERS, MIN_DOWNSAMPLE_POINTS
+from .search import search_patients, search_terms
+from .mqtt import send_control
+from . import metrics as request_metrics
+from django.contrib.auth.views import redirect_to_login
+from django.utils.crypto import constant_time_compare
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.functions import Coalesce
+import numpy as np
 import pandas as pd
 from django.views.decorators.http import require_POST, require_http_methods
 from django.db import transaction
@@ -23,38 +36,53 @@ User = get_user_model()
 def is_admin(user):
     return hasattr(user, 'profile') and user.profile.is_admin
 
+def get_session_arrays(session):
+    """Return (wavelengths, intensities) for a session, empty if it has no data"""
+    spectrum = session.get_spectrum()
+    if spectrum is None:
+        return np.empty(0), np.empty(0)
+    return spectrum.as_arrays()
+
+def sessions_with_data():
+    """Sessions with patient and device joined and their point count and spectrum summary annotated"""
+    return MeasurementSession.objects.select_related('patient', 'device').annotate(
+        point_count=Coalesce('spectrum__point_count', 0),
+        **{name: F(f'spectrum__{name}') for name in Spectrum.SUMMARY_FIELDS},
+    )
+
+# Charts never need more points than this; exports keep full resolution
+CHART_MAX_POINTS = 2000
+CHART_CACHE_TIMEOUT = 60 * 60
+
+def get_chart_arrays(session, spectrum, max_points=CHART_MAX_POINTS, method='lttb'):
+    """Return the spectrum downsampled to at most max_points for charting.
+    
+    Results for completed sessions are cached per revision and resolution.
+    """
+    wavelengths, intensities = spectrum.as_arrays()
+    if wavelengths.size <= max_points:
+        return wavelengths, intensities
+    
+    key = f'chart:{spectrum.pk}:{spectrum.revision}:{method}:{max_points}'
+    if session.status == 'completed':
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    result = DOWNSAMPLERS[method](wavelengths, intensities, max_points)
+    if session.status == 'completed':
+        cache.set(key, result, CHART_CACHE_TIMEOUT)
+    return result
+
 @login_required
 def dashboard(request):
     patients = Patient.objects.all()[:10]
     
-    # Get the most recent sessions with their data status
-    from django.db import connection
-    from django.db.utils import DEFAULT_DB_ALIAS
-    from django.db.models import F
-    
-    # Use the ORM to get sessions with their data status
-    from .models import MeasurementSession, SpectralPoint
-    
-    # Get the most recent 10 sessions
-    sessions = MeasurementSession.objects.all().order_by('-created_at')[:10]
-    
-    # Update status for each session if needed
-    session_objects = []
-    for session in sessions:
-        # Check if session has data
-        has_data = SpectralPoint.objects.filter(session=session).exists()
-        
-        # If session has data but status is still 'in_progress', update it
-        if has_data and session.status == 'in_progress':
-            session.status = 'completed'
-            session.save(update_fields=['status', 'updated_at'])
-        
-        # Add to the result set
-        session_objects.append(session)
+    # Get the most recent 10 sessions; status is kept current by ingestion
+    sessions = sessions_with_data().order_by('-created_at')[:10]
     
     return render(request, 'patients/dashboard.html', {
         'patients': patients,
-        'sessions': session_objects
+        'sessions': sessions
     })
 
 @login_required
@@ -100,40 +128,61 @@ def device_toggle_active(request, pk):
     messages.success(request, f'Device {device.name} has been {status}.')
     return redirect('patients:device_list')
 
+PATIENTS_PER_PAGE = 25
+
 @login_required
 def patient_list(request):
     q = request.GET.get('q','')
-    patients = Patient.objects.filter(name__icontains=q) if q else Patient.objects.all()
-    return render(request,'patients/patient_list.html',{'patients':patients,'q':q})
+    after = request.GET.get('after')
+    try:
+        patients, next_cursor = search_patients(q, after=after, limit=PATIENTS_PER_PAGE)
+    except ValueError:
+        # A tampered or stale cursor just restarts from the first page
+        after = None
+        patients, next_cursor = search_patients(q, limit=PATIENTS_PER_PAGE)
+    return render(request,'patients/patient_list.html',{
+        'patients':patients,
+        'q':q,
+        'is_first_page':not after,
+        'next_cursor':next_cursor,
+    })
+
+@login_required
+@require_GET
+def patient_autocomplete(request):
+    """Return up to 10 patients matching the typed prefix as JSON"""
+    q = request.GET.get('q', '').strip()
+    # Queries without word terms would match every patient
+    if len(q) < 2 or not search_terms(q):
+        return JsonResponse({'results': []})
+    patients, _ = search_patients(q, limit=10)
+    return JsonResponse({'results': [
+        {
+            'id': patient.pk,
+            'patient_id': patient.patient_id,
+            'name': patient.name,
+            'url': reverse('patients:patient_detail', args=[patient.pk]),
+        }
+        for patient in patients
+    ]})
 
 from django.contrib import messages
-from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
+from .mail import enqueue_email
 
-def send_patient_email_async(patient, created_by):
-    """Helper function to send email in a separate thread"""
-    try:
-        subject = f"New Patient Registration: {patient.name}"
-        html_message = render_to_string('patients/email/patient_created.html', {
-            'patient': patient,
-            'created_by': created_by,
-        })
-        plain_message = strip_tags(html_message)
-        
-        send_mail(
-            subject=subject,
-            message=plain_message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[patient.email],
-            html_message=html_message,
-            fail_silently=True,  # Don't raise exceptions for email failures
-        )
-    except Exception as e:
-        # Log the error but don't show to user
-        import logging
-        logger = logging.getLogger(__name__)
-        logger.error(f"Failed to send patient email: {str(e)}")
+def queue_patient_email(patient, created_by):
+    """Add the registration email to the outbox for the send_queued_mail worker"""
+    html_message = render_to_string('patients/email/patient_created.html', {
+        'patient': patient,
+        'created_by': created_by,
+    })
+    enqueue_email(
+        subject=f"New Patient Registration: {patient.name}",
+        body=strip_tags(html_message),
+        to=[patient.email],
+        html_body=html_message,
+    )
 
 @login_required
 def patient_create(request):
@@ -146,16 +195,10 @@ def patient_create(request):
             success_message = f"Patient created successfully! Patient ID: {patient.patient_id}"
             messages.success(request, success_message)
             
-            # Send email in background thread if email is provided
+            # Queue the registration email; the outbox worker sends it
             if patient.email:
                 try:
-                    # Start a new thread to send the email
-                    email_thread = Thread(
-                        target=send_patient_email_async,
-                        args=(patient, request.user.get_full_name() or request.user.username)
-                    )
-                    email_thread.daemon = True  # Thread will close when main program exits
-                    email_thread.start()
+                    queue_patient_email(patient, request.user.get_full_name() or request.user.username)
                 except Exception as e:
                     import logging
                     logger = logging.getLogger(__name__)
@@ -205,28 +248,15 @@ def patient_detail(request, pk):
                     status='in_progress'  # Start with in_progress
                 )
                 
-                # Publish control message to device-specific topic
-                control_topic = f"device/{device.device_id}/control"
-                payload = {
+                # Sent by the shared publisher after commit, so the request never waits on the broker
+                send_control(device.device_id, {
                     'command': 'start_measurement',
                     'timestamp': timezone.now().isoformat(),
                     'session_id': str(session.session_id)
-                }
-                try:
-                    publish.single(
-                        control_topic,
-                        payload=json.dumps(payload),
-                        hostname=settings.MQTT['BROKER'],
-                        port=settings.MQTT['PORT'],
-                        qos=1,
-                        retain=False
-                    )
-                    messages.success(request, f"Measurement started. Session ID: {session.session_id}")
-                except Exception as e:
-                    logger.error(f"Failed to publish MQTT message: {str(e)}")
-                    messages.error(request, "Failed to start measurement. Please try again.")
-                
-                return redirect('patients:patient_detail', pk=pk)
+                })
+
+            messages.success(request, f"Measurement started. Session ID: {session.session_id}")
+            return redirect('patients:patient_detail', pk=pk)
                 
         except Exception as e:
             messages.error(request, f"Error starting measurement: {str(e)}")
@@ -235,22 +265,13 @@ def patient_detail(request, pk):
     # Get active devices for the dropdown
     active_devices = Device.objects.filter(is_active=True)
     
-    # Get recent sessions for this patient
-    recent_sessions = MeasurementSession.objects.filter(
-        patient=patient
-    ).select_related('device').order_by('-created_at')[:5]
-    
-    # Update status for each session if needed
-    for session in recent_sessions:
-        has_data = session.spectra.exists()
-        if has_data and session.status == 'in_progress':
-            session.status = 'completed'
-            session.save(update_fields=['status', 'updated_at'])
+    # Get this patient's sessions in one query; status is kept current by ingestion
+    sessions = sessions_with_data().filter(patient=patient).order_by('-created_at')
     
     return render(request, 'patients/patient_detail.html', {
         'patient': patient,
         'active_devices': active_devices,
-        'recent_sessions': recent_sessions
+        'sessions': sessions
     })
 
 @login_required
@@ -276,23 +297,32 @@ def patient_delete(request, pk):
 def session_detail(request, session_id):
     # Get the session with related data
     session = get_object_or_404(
-        MeasurementSession.objects.select_related('patient', 'device', 'initiated_by'),
+        MeasurementSession.objects.select_related('patient', 'device', 'initiated_by', 'spectrum'),
         session_id=session_id
     )
     
-    # Get all spectral points ordered by wavelength
-    spectral_points = session.spectra.all().order_by('wavelength')
-    has_data = spectral_points.exists()
-    
-    # Update status if needed
-    if has_data and session.status == 'in_progress':
-        session.status = 'completed'
-        session.save(update_fields=['status', 'updated_at'])
+    # Read the packed spectrum, which is stored sorted by wavelength
+    spectrum = session.get_spectrum()
+    wavelengths, intensities = get_session_arrays(session)
+    has_data = wavelengths.size > 0
+    if spectrum:
+        chart_wavelengths, chart_intensities = get_chart_arrays(session, spectrum)
+    else:
+        chart_wavelengths, chart_intensities = wavelengths, intensities
+    # The table is capped like the chart; the export has every point
+    spectral_points = [
+        {'wavelength': wavelength, 'intensity': intensity}
+        for wavelength, intensity in zip(
+            wavelengths[:CHART_MAX_POINTS].tolist(), intensities[:CHART_MAX_POINTS].tolist()
+        )
+    ]
     
     # Prepare chart data
     chart_data = {
-        'wavelengths': [str(point.wavelength) for point in spectral_points],
-        'intensities': [float(point.intensity) for point in spectral_points],
+        'wavelengths': chart_wavelengths.tolist(),
+        'intensities': chart_intensities.tolist(),
+        'revision': spectrum.revision if spectrum else 0,
+        'max_points': CHART_MAX_POINTS,
         'has_data': has_data
     }
     
@@ -308,32 +338,61 @@ def session_detail(request, session_id):
     return render(request, 'patients/session_detail.html', {
         'session': session,
         'spectral_points': spectral_points,
+        'point_count': wavelengths.size,
         'chart_data': chart_data,
     })
 
 @login_required
 @require_GET
 def session_data(request, session_id):
-    """Return session data as JSON for the chart"""
-    # Get the session and force a fresh database query
-    session = get_object_or_404(MeasurementSession.objects.select_for_update(), session_id=session_id)
+    """Return session data as JSON for the chart.
     
-    # Force a database refresh
-    session.refresh_from_db()
+    With ``?since=<revision>`` only the points added after that revision are
+    returned; clients pass back the ``revision`` from the previous response.
+    Full reads can be downsampled with ``?max_points=<n>`` or ``?width=<px>``
+    (two points per pixel) and ``?method=lttb|minmax``.
+    """
+    params = {}
+    for key in ('since', 'max_points', 'width'):
+        value = request.GET.get(key)
+        if value is not None:
+            try:
+                params[key] = int(value)
+                if params[key] < 0:
+                    raise ValueError
+            except ValueError:
+                return JsonResponse({'error': f'{key} must be a non-negative integer'}, status=400)
+    since = params.get('since')
+    max_points = params.get('max_points') or 2 * params.get('width', 0) or None
+    if max_points is not None and max_points < MIN_DOWNSAMPLE_POINTS:
+        key = 'max_points' if params.get('max_points') else 'width'
+        minimum = MIN_DOWNSAMPLE_POINTS if key == 'max_points' else (MIN_DOWNSAMPLE_POINTS + 1) // 2
+        return JsonResponse({'error': f'{key} must be at least {minimum}'}, status=400)
+    method = request.GET.get('method', 'lttb')
+    if method not in DOWNSAMPLERS:
+        return JsonResponse({'error': f'Unknown method: {method}'}, status=400)
     
-    # Get the latest points
-    points = session.spectra.all().order_by('wavelength')
+    # A plain read: the spectrum is replaced atomically by each ingestion write
+    session = get_object_or_404(MeasurementSession.objects.select_related('spectrum'), session_id=session_id)
+    spectrum = session.get_spectrum()
     
-    # Update status to 'completed' if there are any points and status is still 'in_progress'
-    if points.exists() and session.status == 'in_progress':
-        session.status = 'completed'
-        session.save(update_fields=['status', 'updated_at'])
+    # Get the latest points, or only the new ones
+    if spectrum is None:
+        wavelengths, intensities = np.empty(0), np.empty(0)
+    elif since is not None:
+        wavelengths, intensities = spectrum.since(since)
+    elif max_points:
+        wavelengths, intensities = get_chart_arrays(session, spectrum, max_points, method)
+    else:
+        wavelengths, intensities = spectrum.as_arrays()
     
     data = {
-        'wavelengths': [float(p.wavelength) for p in points],
-        'intensities': [float(p.intensity) for p in points],
+        'wavelengths': wavelengths.tolist(),
+        'intensities': intensities.tolist(),
         'status': session.status,
-        'point_count': points.count()
+        'point_count': spectrum.point_count if spectrum else 0,
+        'revision': spectrum.revision if spectrum else 0,
+        'since': since
     }
     
     return JsonResponse(data)
@@ -341,21 +400,25 @@ def session_data(request, session_id):
 @login_required
 def export_csv(request, session_id):
     session = get_object_or_404(MeasurementSession, session_id=session_id)
-    qs = SpectralPoint.objects.filter(session=session).order_by('wavelength')
-    rows = [{'wavelength': p.wavelength, 'intensity': p.intensity} for p in qs]
-    df = pd.DataFrame(rows)
-    buf = io.StringIO()
-    df.to_csv(buf, index=False)
-    resp = HttpResponse(buf.getvalue(), content_type='text/csv')
+    wavelengths, intensities = get_session_arrays(session)
+    
+    # Stream rows in chunks straight from the packed arrays
+    chunks = iter_csv(wavelengths, intensities)
+    use_gzip = accepts_gzip(request)
+    if use_gzip:
+        chunks = compress_sequence(chunks)
+    resp = StreamingHttpResponse(response_chunks(request, chunks), content_type='text/csv')
+    if use_gzip:
+        resp['Content-Encoding'] = 'gzip'
+    patch_vary_headers(resp, ('Accept-Encoding',))
     resp['Content-Disposition'] = f'attachment; filename="session_{session_id}.csv"'
     return resp
 
 @login_required
 def export_xlsx(request, session_id):
     session = get_object_or_404(MeasurementSession, session_id=session_id)
-    qs = SpectralPoint.objects.filter(session=session).order_by('wavelength')
-    rows = [{'wavelength': p.wavelength, 'intensity': p.intensity} for p in qs]
-    df = pd.DataFrame(rows)
+    wavelengths, intensities = get_session_arrays(session)
+    df = pd.DataFrame({'wavelength': wavelengths, 'intensity': intensities})
     buf = io.BytesIO()
     with pd.ExcelWriter(buf, engine='openpyxl') as writer:
         df.to_excel(writer, index=False, sheet_name='spectra')
@@ -363,3 +426,59 @@ def export_xlsx(request, session_id):
     resp = HttpResponse(buf.read(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
     resp['Content-Disposition'] = f'attachment; filename="session_{session_id}.xlsx"'
     return resp
+
+@login_required
+@require_GET
+def export_sessions(request):
+    """Stream the data of every session matching the filters as one archive"""
+    export_format = request.GET.get('format', 'zip')
+    if export_format not in EXPORT_FORMATS:
+        return JsonResponse({'error': f'Unknown format: {export_format}'}, status=400)
+    
+    dates = {}
+    for key in ('start', 'end'):
+        value = request.GET.get(key)
+        if value:
+            try:
+                dates[key] = parse_date(value)
+            except ValueError:
+                dates[key] = None
+            if dates[key] is None:
+                return JsonResponse({'error': f'Invalid {key} date, expected YYYY-MM-DD'}, status=400)
+    
+    sessions = filter_sessions(
+        patient=request.GET.get('patient'),
+        device=request.GET.get('device'),
+        status=request.GET.get('status'),
+        **dates
+    )
+    writer, content_type, extension = EXPORT_FORMATS[export_format]
+    try:
+        chunks = writer(iter_spectra(sessions))
+    except ImportError:
+        return JsonResponse({'error': f'{export_format} export is not available on this server'}, status=400)
+    
+    resp = StreamingHttpResponse(response_chunks(request, chunks), content_type=content_type)
+    resp['Content-Disposition'] = f'attachment; filename="sessions_{timezone.now():%Y%m%d_%H%M%S}.{extension}"'
+    return resp
+
+def metrics_token_ok(request):
+    token = settings.METRICS.get('TOKEN')
+    return bool(token) and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+@require_GET
+def metrics(request):
+    """Prometheus text metrics for this process; admins or the configured bearer token only"""
+    if not metrics_token_ok(request):
+        if not request.user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        if not is_admin(request.user):
+            raise PermissionDenied
+    return HttpResponse(request_metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@login_required
+@user_passes_test(is_admin)
+@require_GET
+def slow_requests(request):
+    """Recently sampled slow requests with their SQL, newest first"""
+    return JsonResponse({'samples': list(reversed(request_metrics.slow_samples))})